@@ -0,0 +1,103 @@
+"""Benchmark the notebook transforms used to pre-process the Jupyter Book.
+
+Runs each transform on synthetic notebooks of increasing length and prints
+the time per cell, which should stay roughly constant if a transform scales
+linearly with the number of cells. The full pipeline is timed both fused into
+a single pass over the cells and as one pass per transform.
+
+Usage: python scripts/benchmark_book.py [--sizes 500 1000 2000 4000]
+
+"""
+import sys
+import copy
+import time
+import argparse
+import generate_book
+
+
+def main(arglist):
+
+    args = parse_args(arglist)
+
+    bench_link_hidden_cells(args.sizes, args.repeat)
+    bench_pipeline(args.sizes, args.repeat)
+
+
+def parse_args(arglist):
+
+    parser = argparse.ArgumentParser(__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 1000, 2000, 4000],
+                        help="Numbers of cells in the synthetic notebooks")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed runs per size (the best is reported)")
+
+    return parser.parse_args(arglist)
+
+
+def synthetic_notebook(n_cells):
+    """Make a notebook with a mix of headers, hidden cells, videos and code."""
+    cells = [{
+        "cell_type": "markdown",
+        "metadata": {},
+        "source": ['<a href="https://colab.research.google.com/"><img src="badge.svg"/></a>'],
+    }]
+    templates = [
+        {"cell_type": "markdown", "metadata": {}, "source": ["# Section\n", "Some text"]},
+        {"cell_type": "code", "metadata": {}, "source": [
+            "# @title Video\n",
+            "from IPython.display import YouTubeVideo\n",
+            "video = YouTubeVideo(id='abc', width=854, height=480)",
+        ]},
+        {"cell_type": "code", "metadata": {}, "source": ["# @markdown Run this cell\n", "x = 1"]},
+        {"cell_type": "code", "metadata": {}, "source": ["y = x + 1\n", "print(y)"]},
+    ]
+    for i in range(n_cells - 1):
+        cells.append(copy.deepcopy(templates[i % len(templates)]))
+    return {"cells": cells, "metadata": {}, "nbformat": 4, "nbformat_minor": 5}
+
+
+def time_transform(transform, content, repeat):
+    """Return the best time to run a transform on fresh copies of a notebook."""
+    times = []
+    for _ in range(repeat):
+        fresh = copy.deepcopy(content)
+        start = time.perf_counter()
+        transform(fresh)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def report_scaling(name, sizes, times):
+    print(name)
+    for n_cells, seconds in zip(sizes, times):
+        print(f"  {n_cells:6d} cells: {seconds * 1e3:8.2f} ms ({seconds / n_cells * 1e6:6.2f} us/cell)")
+
+
+def bench_link_hidden_cells(sizes, repeat):
+    times = [
+        time_transform(generate_book.link_hidden_cells, synthetic_notebook(n), repeat)
+        for n in sizes
+    ]
+    report_scaling("link_hidden_cells", sizes, times)
+
+
+def unfused_pipeline(content):
+    content = generate_book.open_in_colab_new_tab(content)
+    content = generate_book.change_video_widths(content)
+    return generate_book.link_hidden_cells(content)
+
+
+def fused_pipeline(content):
+    return generate_book.run_transforms(content, generate_book.book_transforms())
+
+
+def bench_pipeline(sizes, repeat):
+    for name, pipeline in [("pipeline (unfused)", unfused_pipeline),
+                           ("pipeline (fused)", fused_pipeline)]:
+        times = [time_transform(pipeline, synthetic_notebook(n), repeat) for n in sizes]
+        report_scaling(name, sizes, times)
+
+
+if __name__ == "__main__":
+
+    main(sys.argv[1:])
@@ -8,11 +8,27 @@ import ast
 import collections
 import json
 import os
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError
+import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit
 
-import nbformat
+from result_cache import CACHE_DIR, write_json
+
+OSF_API_URL = os.environ.get("OSF_API_URL", "https://api.osf.io/v2")
+
+# Lines assigning video or slide ids, e.g. `link_id = "abcde"`
+LINK_PATTERN = re.compile(r"^\s*(video_ids|link_id) = (.*)$", re.MULTILINE)
+
+# HTTP statuses worth retrying: rate limiting and server-side errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# How long (in seconds) to trust cached filenames and cached missing files
+CACHE_TTL = 30 * 24 * 3600
+NOT_FOUND_TTL = 24 * 3600
 
 
 def bilibili_url(video_id):
@@ -51,6 +67,86 @@ def miniunit_order(fname):
         order = 30
     return (category, unit, order)
 
+def resolve_filenames(link_ids, api_url, jobs, retries=3, backoff=0.5):
+    """Look up OSF filenames for link ids, returning (status, name) pairs.
+
+    Requests are spread over a pool of threads, each of which keeps its own
+    persistent connection to the API. Connection errors and transient HTTP
+    errors are retried with exponential backoff. For unsuccessful requests,
+    the HTTP reason phrase is returned in place of the name.
+    """
+    parts = urlsplit(api_url)
+    connection_class = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+    local = threading.local()
+
+    def lookup(link_id):
+        path = f"{parts.path.rstrip('/')}/files/{link_id}/"
+        for attempt in range(retries + 1):
+            if getattr(local, "connection", None) is None:
+                local.connection = connection_class(parts.netloc, timeout=30)
+            try:
+                local.connection.request(
+                    "GET", path, headers={"Accept": "application/json"}
+                )
+                response = local.connection.getresponse()
+                body = response.read()
+            except (OSError, HTTPException):
+                local.connection.close()
+                local.connection = None
+                if attempt == retries:
+                    raise
+            else:
+                if response.status == 200:
+                    return 200, json.loads(body)["data"]["attributes"]["name"]
+                if response.status not in RETRY_STATUSES or attempt == retries:
+                    return response.status, response.reason
+            time.sleep(backoff * 2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lookup, link_ids))
+
+
+def cached_filenames(link_ids, api_url, jobs, cache_path, refresh=False):
+    """Look up OSF filenames like resolve_filenames, reusing a local JSON cache.
+
+    Filenames and 404 responses are cached (the latter for a shorter time);
+    other failures are always retried on the next run. With refresh, every
+    link id is looked up again and its cache entry replaced.
+    """
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entries = cache.setdefault(api_url, {})
+
+    now = time.time()
+
+    def is_fresh(entry):
+        ttl = CACHE_TTL if entry["status"] == 200 else NOT_FOUND_TTL
+        return now - entry["time"] < ttl
+
+    stale = [
+        link_id for link_id in dict.fromkeys(link_ids)
+        if refresh or link_id not in entries or not is_fresh(entries[link_id])
+    ]
+    uncached = {}
+    for link_id, (status, name) in zip(stale, resolve_filenames(stale, api_url, jobs)):
+        if status in (200, 404):
+            entries[link_id] = {"status": status, "name": name, "time": now}
+        else:
+            uncached[link_id] = status, name
+
+    if stale:
+        write_json(cache_path, cache, indent=1)
+
+    return [
+        uncached[link_id] if link_id in uncached
+        else (entries[link_id]["status"], entries[link_id]["name"])
+        for link_id in link_ids
+    ]
+
+
 def main(arglist):
     """Process IPython notebooks from a list of files."""
     args = parse_args(arglist)
@@ -63,24 +159,30 @@ def main(arglist):
         print("No notebook files found")
         sys.exit(0)
 
-    videos = collections.defaultdict(list)
-    slides = collections.defaultdict(list)
+    videos = collections.defaultdict(dict)
+    slide_links = {}
 
     for nb_path in sorted(nb_paths, key=miniunit_order):
-        # Load the notebook structure
-        with open(nb_path) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
+        # Load the raw notebook, skipping those without any links
+        with open(nb_path, encoding="utf-8") as f:
+            raw = f.read()
+        if "video_ids = " not in raw and "link_id = " not in raw:
+            continue
+        nb = json.loads(raw)
 
         # Extract components of the notebook path
         nb_dir, nb_fname = os.path.split(nb_path)
         nb_name, _ = os.path.splitext(nb_fname)
 
-        # Loop through the cells and find video and slide ids
+        # Scan the cells for lines defining video and slide ids
         for cell in nb.get("cells", []):
-            for line in cell.get("source", "").split("\n"):
-                l = line.strip()
-                if l.startswith("video_ids = "):
-                    rhs = l.split("=")[1].strip()
+            source = cell.get("source", "")
+            if isinstance(source, list):
+                source = "".join(source)
+            for match in LINK_PATTERN.finditer(source):
+                kind = match.group(1)
+                rhs = match.group(2).split("=")[0].strip()
+                if kind == "video_ids":
                     video_dict = dict(ast.literal_eval(rhs))
                     try:
                         if args.noyoutube:
@@ -90,29 +192,32 @@ def main(arglist):
                     except KeyError:
                         print(f"Malformed video id in {nb_name}? '{rhs}'")
                         continue
-                    if url not in videos[nb_name]:
-                        videos[nb_name].append(url)
-                elif l.startswith("link_id = "):
-                    rhs = l.split("=")[1].strip()
-                    url = osf_url(ast.literal_eval(rhs))
+                    videos[nb_name][url] = None
+                else:
+                    link_id = ast.literal_eval(rhs)
+                    url = osf_url(link_id)
                     # Slides are sometimes used in multiple notebooks, so we
                     # just store the filename and the link
-                    if url not in slides:
-                        api_request = f"https://api.osf.io/v2/files/{ast.literal_eval(rhs)}/"
-                        httprequest = Request(api_request,
-                                              headers={"Accept": "application/json"})
-                        try:
-                            with urlopen(httprequest) as response:
-                                data = json.load(response)
-                                filename = data["data"]["attributes"]["name"]
-                        except HTTPError as e:
-                            sys.stderr.write(str(e) + "\n")
-                            sys.stderr.write(f"Skipping slide {url}\n")
-                            continue
-                        if 'UnitSummary' in nb_name:
-                            filename = os.path.splitext(filename.replace("_", ""))[0] + '_UnitSummary.pdf'
-                        slides[url] = filename
+                    if url not in slide_links:
+                        slide_links[url] = link_id, nb_name
+
+    # Look up the slide filenames concurrently once all notebooks are read
+    link_ids = [link_id for link_id, _ in slide_links.values()]
+    lookups = cached_filenames(
+        link_ids, args.osf_api, args.jobs, args.cache, args.refresh
+    )
+
+    slides = {}
+    for (url, (link_id, nb_name)), (status, filename) in zip(slide_links.items(), lookups):
+        if status != 200:
+            sys.stderr.write(f"HTTP Error {status}: {filename}\n")
+            sys.stderr.write(f"Skipping slide {url}\n")
+            continue
+        if 'UnitSummary' in nb_name:
+            filename = os.path.splitext(filename.replace("_", ""))[0] + '_UnitSummary.pdf'
+        slides[url] = filename
 
+    videos = {nb_name: list(urls) for nb_name, urls in videos.items()}
     print(json.dumps({"videos": videos, "slides": slides}, indent=4))
 
 
@@ -126,6 +231,27 @@ def parse_args(arglist):
         action="store_true",
         help="Extract Bilibili links instead of youtube",
     )
+    parser.add_argument(
+        "--osf-api",
+        default=OSF_API_URL,
+        help="Base URL of the OSF API (default: $OSF_API_URL or the public API)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of concurrent OSF API requests",
+    )
+    parser.add_argument(
+        "--cache",
+        default=os.path.join(CACHE_DIR, "osf_filenames.json"),
+        help="Path of the JSON file caching OSF filename lookups",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Look up every slide filename again, ignoring cached results",
+    )
     parser.add_argument(
         "files",
         nargs="+",
@@ -4,16 +4,39 @@ import yaml
 from jinja2 import Template
 import traceback
 import json
-from bs4 import BeautifulSoup
+import hashlib
+import re
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 REPO = os.environ.get("C4R_REPO", "default-repo")
-ARG = sys.argv[1]
+
+# Number of units to pre-process in parallel
+JOBS = int(os.environ.get("C4R_BOOK_JOBS", os.cpu_count() or 1))
+
+# Start of an anchor tag, to check that the parser found every anchor
+ANCHOR_START = re.compile(r"<a[\s/>]", re.IGNORECASE)
+
+# Name of an anchor start tag and the attributes of any start tag, as html.parser reads them
+ANCHOR_NAME = re.compile(r"<a(?:\s|/(?!>))*", re.IGNORECASE)
+ATTRIBUTE = re.compile(r'((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*'
+                       r'(\'[^\']*\'|"[^"]*"|(?![\'"])[^>\s]*))?(?:\s|/(?!>))*')
+
+# Hashes of the notebooks as this script last wrote them. Notebooks are
+# processed in place, so one whose hash still matches is already done.
+MANIFEST_PATH = "book/.notebook_manifest.json"
 
 
 def main():
+    # Which version of the notebooks to include (e.g. student or instructor)
+    version = sys.argv[1]
+
     with open('units/materials.yml') as fh:
         materials = yaml.load(fh, Loader=yaml.FullLoader)
 
+    manifest = load_manifest()
+
     # Make the dictionary that contains the chapters
     toc = {}
     for m in materials:
@@ -22,19 +45,20 @@ def main():
     
     art_file_list = os.listdir('units/Art/')
 
+    # Chapter title pages and notebooks to pre-process for each unit
+    units = []
+
     for m in materials:
         directory = f"{m['unit']}_{''.join(m['name'].split())}"
 
         # Make temporary chapter title file
-        with open(f"units/{directory}/chapter_title.md",
-                  "w+") as title_file:
-            title_page = f"# {m['name']}"
-            art_file = [fname for fname in art_file_list if m['unit'] in fname]
-            if len(art_file) == 1:
-                artist = art_file[0].split('-')[1].split('.')[0]
-                artist = artist.replace('_', ' ')
-                title_page += f"\n\n ````{{div}} full-width \n <img src='../Art/{art_file[0]}' alt='art relevant to chapter contents' width='100%'> \n```` \n\n*Artwork by {artist}*"
-            title_file.write(title_page)
+        title_page = f"# {m['name']}"
+        art_file = [fname for fname in art_file_list if m['unit'] in fname]
+        if len(art_file) == 1:
+            artist = art_file[0].split('-')[1].split('.')[0]
+            artist = artist.replace('_', ' ')
+            title_page += f"\n\n ````{{div}} full-width \n <img src='../Art/{art_file[0]}' alt='art relevant to chapter contents' width='100%'> \n```` \n\n*Artwork by {artist}*"
+        title_path = f"units/{directory}/chapter_title.md"
 
         chapter = {'file': f"units/{directory}/chapter_title.md",
                    'title': f"{m['name']} ({m['unit']})",
@@ -45,120 +69,309 @@ def main():
 
         # Make list of notebook sections
         notebook_list = []
-        notebook_list += [f"{directory}/{ARG}/{m['unit']}_Intro.ipynb"] if os.path.exists(f"{directory}/{m['unit']}_Intro.ipynb") else []
-        notebook_list += [f"{directory}/{ARG}/{m['unit']}_MiniUnit{i + 1}.ipynb" for i in range(m['MiniUnits'])]
-        notebook_list += [f"{directory}/{ARG}/{m['unit']}_Outro.ipynb"] if os.path.exists(f"{directory}/{m['unit']}_Outro.ipynb") else []
+        notebook_list += [f"{directory}/{version}/{m['unit']}_Intro.ipynb"] if os.path.exists(f"{directory}/{m['unit']}_Intro.ipynb") else []
+        notebook_list += [f"{directory}/{version}/{m['unit']}_MiniUnit{i + 1}.ipynb" for i in range(m['MiniUnits'])]
+        notebook_list += [f"{directory}/{version}/{m['unit']}_Outro.ipynb"] if os.path.exists(f"{directory}/{m['unit']}_Outro.ipynb") else []
 
-        # Add and process all notebooks
+        # Add all notebooks
         for notebook_file_path in notebook_list:
             chapter['sections'].append({'file': notebook_file_path})
-            pre_process_notebook(notebook_file_path)
 
         # Un-comment out to add add further reading page if they exist, may fail unless each unit has further reading
         # chapter['sections'].append({'file': f"{directory}/further_reading.md"})
 
         # Add unit summary pages if they exist
-        notebook_file_path = f"{directory}/{ARG}/{m['unit']}_UnitSummary.ipynb"
+        notebook_file_path = f"{directory}/{version}/{m['unit']}_UnitSummary.ipynb"
         if os.path.exists(notebook_file_path):
             chapter['sections'].append({'file': notebook_file_path})
-            pre_process_notebook(notebook_file_path)
+            notebook_list.append(notebook_file_path)
 
         # Add chapter
         toc[part]['chapters'].append(chapter)
+        units.append((title_path, title_page, notebook_list))
 
     # Turn toc into list
     toc_list = [{'file': f"units/intro.ipynb"}]
     if os.path.exists(f"units/intro.ipynb"):
-        pre_process_notebook(f"units/intro.ipynb")
+        units.append((None, None, ["units/intro.ipynb"]))
+
+    # Process the units, spreading them across processes
+    process = partial(pre_process_unit, manifest=manifest)
+    if JOBS > 1 and len(units) > 1:
+        with ProcessPoolExecutor(min(JOBS, len(units))) as pool:
+            updates = list(pool.map(process, units))
+    else:
+        updates = map(process, units)
+    for update in updates:
+        manifest.update(update)
 
     for key in toc.keys():        
         toc_list.append(toc[key])
 
-    with open('book/_toc.yml', 'w') as fh:
-        yaml.dump(toc_list, fh)
+    write_if_changed('book/_toc.yml', yaml.dump(toc_list))
 
+    save_manifest(manifest)
 
-def pre_process_notebook(file_path):
 
-    with open(file_path, encoding="utf-8") as read_notebook:
-        content = json.load(read_notebook)
-    pre_processed_content = open_in_colab_new_tab(content)
-    pre_processed_content = change_video_widths(pre_processed_content)
-    pre_processed_content = link_hidden_cells(pre_processed_content)
-    with open(file_path, "w", encoding="utf-8") as write_notebook:
-        json.dump(pre_processed_content, write_notebook, indent=1, ensure_ascii=False)
+def pre_process_unit(unit, manifest):
+    """Write a unit's chapter title page and pre-process its notebooks.
 
+    Returns the manifest entries of the unit's notebooks.
+    """
+    title_path, title_page, notebook_list = unit
+    if title_path is not None:
+        write_if_changed(title_path, title_page)
 
-def open_in_colab_new_tab(content):
-    cells = content['cells']
-    parsed_html = BeautifulSoup(cells[0]['source'][0], "html.parser")
+    entries = {path: manifest[path] for path in notebook_list if path in manifest}
+    for notebook_file_path in notebook_list:
+        pre_process_notebook(notebook_file_path, entries)
+    return entries
+
+
+def pre_process_notebook(file_path, manifest=None):
+    """Pre-process a notebook in place, unless the manifest shows it is done."""
+    with open(file_path, "rb") as read_notebook:
+        data = read_notebook.read()
+    if manifest is not None and manifest.get(file_path) == content_hash(data):
+        return
+
+    content = json.loads(data.decode("utf-8"))
+    pre_processed_content = run_transforms(content, book_transforms())
+    output = json.dumps(pre_processed_content, indent=1, ensure_ascii=False)
+    write_if_changed(file_path, output)
+
+    if manifest is not None:
+        manifest[file_path] = content_hash(output.encode("utf-8"))
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_if_changed(path, text):
+    """Write text to a file, leaving it untouched if it already has that content.
+
+    Keeping the mtime of unchanged files avoids invalidating jupyter-book's cache.
+    """
+    data = text.encode("utf-8")
+    try:
+        with open(path, "rb") as fh:
+            if fh.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as fh:
+        fh.write(data)
+    return True
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest):
+    write_if_changed(MANIFEST_PATH, json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def book_transforms():
+    """Return the transforms applied to every notebook in the book, in order."""
+    return [OpenInColabNewTab(), ChangeVideoWidths(), LinkHiddenCells()]
+
+
+def run_transforms(content, transforms):
+    """Apply several transforms to a notebook in a single pass over its cells.
+
+    Each original cell goes through the transforms in order, each of which
+    may replace it with any number of cells for the next one, so the result
+    is the same as running the transforms one after another.
+    """
+    for transform in transforms:
+        transform.begin(content)
+
+    updated_cells = []
+    for i, cell in enumerate(content['cells']):
+        cells = [cell]
+        for transform in transforms:
+            cells = [new_cell for cell in cells for new_cell in transform.cell(i, cell)]
+        updated_cells.extend(cells)
+
+    content['cells'] = updated_cells
+    return content
+
+
+class NotebookTransform:
+    """A transform of notebook cells that can share a pass with other transforms."""
+
+    def begin(self, content):
+        """Prepare to transform a notebook, before any of its cells."""
+
+    def cell(self, i, cell):
+        """Transform the i-th cell of the notebook, returning the cells to keep."""
+        return [cell]
+
+
+class OpenInColabNewTab(NotebookTransform):
+    """Make the links in the first cell (e.g. the Colab badge) open in a new tab."""
+
+    def cell(self, i, cell):
+        if i == 0:
+            html = cell['source'][0]
+            try:
+                cell['source'][0] = set_anchor_targets(html)
+            except ValueError:
+                cell['source'][0] = set_anchor_targets_bs4(html)
+        return [cell]
+
+
+class AnchorFinder(HTMLParser):
+    """Collect the raw anchor start tags of an HTML fragment with their positions."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.anchors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.anchors.append((self.getpos(), self.get_starttag_text(), attrs))
+
+
+def set_anchor_targets(html):
+    """Add target="_blank" to the anchors of an HTML fragment.
+
+    Only the anchor start tags are rewritten, the rest of the text is kept
+    byte for byte. Raises ValueError if the anchors cannot all be found
+    reliably, e.g. in malformed HTML.
+    """
+    if not ANCHOR_START.search(html):
+        return html
+
+    finder = AnchorFinder()
+    finder.feed(html)
+    finder.close()
+    if len(finder.anchors) != len(ANCHOR_START.findall(html)):
+        raise ValueError("Could not find all the anchors")
+
+    line_starts = [0]
+    for line in html.split("\n")[:-1]:
+        line_starts.append(line_starts[-1] + len(line) + 1)
+
+    pieces = []
+    end = 0
+    for (line, column), tag_text, attrs in finder.anchors:
+        start = line_starts[line - 1] + column
+        if html[start:start + len(tag_text)] != tag_text:
+            raise ValueError("Could not locate an anchor")
+        pieces += [html[end:start], set_anchor_target(tag_text, attrs)]
+        end = start + len(tag_text)
+    pieces.append(html[end:])
+
+    return "".join(pieces)
+
+
+def set_anchor_target(tag_text, attrs):
+    """Set target="_blank" in the raw text of an anchor start tag."""
+    spans = {}
+    insert_at = 2
+    position = ANCHOR_NAME.match(tag_text).end()
+    while True:
+        match = ATTRIBUTE.match(tag_text, position)
+        if not match:
+            break
+        insert_at = match.end(2) if match.group(2) else match.end(1)
+        spans[match.group(1).lower()] = match.start(1), insert_at
+        position = match.end()
+    names = [name for name, _ in attrs]
+    if list(spans) != names:
+        raise ValueError("Could not parse the anchor attributes")
+
+    if 'target' in spans:
+        start, end = spans['target']
+        return tag_text[:start] + 'target="_blank"' + tag_text[end:]
+    return tag_text[:insert_at] + ' target="_blank"' + tag_text[insert_at:]
+
+
+def set_anchor_targets_bs4(html):
+    """Add target="_blank" to the anchors of an HTML fragment, however malformed."""
+    from bs4 import BeautifulSoup
+
+    parsed_html = BeautifulSoup(html, "html.parser")
     for anchor in parsed_html.findAll('a'):
         # Open in new tab
         anchor['target'] = '_blank'
-    cells[0]['source'][0] = str(parsed_html)
-    return content
+    return str(parsed_html)
 
-def link_hidden_cells(content):
-    cells = content['cells']
-    updated_cells = cells.copy()
 
-    i_updated_cell = 0
-    for i_cell, cell in enumerate(cells):
-        updated_cell = updated_cells[i_updated_cell]
+class LinkHiddenCells(NotebookTransform):
+    """Tag cells with hidden code and add markdown headers for their titles."""
+
+    def begin(self, content):
+        self.header_level = None
+
+    def cell(self, i, cell):
         if "source" not in cell:
-            continue
+            return [cell]
+        updated_cells = []
         source = cell['source'][0]
 
         if source.startswith("#") and cell['cell_type'] == 'markdown':
-            header_level = source.count('#')
+            self.header_level = source.count('#')
         elif source.startswith("---") and cell['cell_type'] == 'markdown':
             if len(cell['source']) > 1 and cell['source'][1].startswith("#") and cell['cell_type'] == 'markdown':
-                header_level = cell['source'][1].count('#')
+                self.header_level = cell['source'][1].count('#')
 
         if '@title' in source or '@markdown' in source:
             if 'metadata' not in cell:
-                updated_cell['metadata'] = {}
+                cell['metadata'] = {}
             if 'tags' not in cell['metadata']:
-                updated_cell['metadata']['tags'] = []
+                cell['metadata']['tags'] = []
 
             # Check if cell is video one
-            if 'YouTubeVideo' in ''.join(cell['source']) or 'IFrame' in ''.join(cell['source']):
+            cell_text = ''.join(cell['source'])
+            if 'YouTubeVideo' in cell_text or 'IFrame' in cell_text:
                 if "remove-input" not in cell['metadata']['tags']:
-                    updated_cell['metadata']['tags'].append("remove-input")
+                    cell['metadata']['tags'].append("remove-input")
             else:
                 if "hide-input" not in cell['metadata']['tags']:
-                    updated_cell['metadata']['tags'].append("hide-input")
+                    cell['metadata']['tags'].append("hide-input")
 
             # If header is lost, create one in markdown
             if '@title' in source:
 
-                if source.split('@title')[1] != '':
+                title = source.split('@title')[1]
+                if title != '':
                     header_cell = {
                         'cell_type': 'markdown',
                         'metadata': {},
-                        'source': ['#'*(header_level + 1) + ' ' + source.split('@title')[1]]}
-                    updated_cells.insert(i_updated_cell, header_cell)
-                    i_updated_cell += 1
+                        'source': ['#'*(self.header_level + 1) + ' ' + title]}
+                    updated_cells.append(header_cell)
 
-            strings_with_markdown = [(i, string) for i, string in enumerate(cell['source']) if '@markdown' in string]
+            strings_with_markdown = [string for string in cell['source'] if '@markdown' in string]
             if len(strings_with_markdown) == 1:
-                i = strings_with_markdown[0][0]
-                if cell['source'][i].split('@markdown')[1] != '':
+                markdown = strings_with_markdown[0].split('@markdown')[1]
+                if markdown != '':
                     header_cell = {
                         'cell_type': 'markdown',
                         'metadata': {},
-                        'source': [cell['source'][i].split('@markdown')[1]]}
-                    updated_cells.insert(i_updated_cell, header_cell)
-                    i_updated_cell += 1
+                        'source': [markdown]}
+                    updated_cells.append(header_cell)
 
-        i_updated_cell += 1
+        updated_cells.append(cell)
+        return updated_cells
 
-    content['cells'] = updated_cells
-    return content
 
-def change_video_widths(content):
+class ChangeVideoWidths(NotebookTransform):
+    """Shrink embedded videos and show slides in a widget to fit the book."""
 
-    for i, cell in enumerate(content['cells']):
+    def begin(self, content):
+        # The first cell is compared with the last one, as cells[i - 1] would
+        self.previous_cell = content['cells'][-1] if content['cells'] else None
+        self.slide_link = None
+
+    def cell(self, i, cell):
         if 'YouTubeVideo' in ''.join(cell['source']):
 
             for ind in range(len(cell['source'])):
@@ -167,12 +380,14 @@ def change_video_widths(content):
                 cell['source'][ind] = cell['source'][ind].replace('480', '410')
 
         # Put slides in ipywidget so they don't overlap margin
-        if '# @title MiniUnit slides\n' in cell['source'] or '# @title Slides\n' in cell['source'] or '## Slides' in content['cells'][i-1]['source']:
+        if '# @title MiniUnit slides\n' in cell['source'] or '# @title Slides\n' in cell['source'] or '## Slides' in self.previous_cell['source']:
             for line in cell['source']:
                 if line.startswith('link_id'):
-                    slide_link = line.split('"')[1]
-            download_link = f"https://osf.io/download/{slide_link}/"
-            render_link = f"https://mfr.ca-1.osf.io/render?url=https://osf.io/{slide_link}/?direct%26mode=render%26action=download%26mode=render"
+                    self.slide_link = line.split('"')[1]
+            if self.slide_link is None:
+                raise ValueError("Slides cell without a link_id")
+            download_link = f"https://osf.io/download/{self.slide_link}/"
+            render_link = f"https://mfr.ca-1.osf.io/render?url=https://osf.io/{self.slide_link}/?direct%26mode=render%26action=download%26mode=render"
             cell['source'] = ['# @markdown\n',
                               'from IPython.display import IFrame\n',
                               'from ipywidgets import widgets\n',
@@ -181,7 +396,39 @@ def change_video_widths(content):
                               f'    print(f"If you want to download the slides: {download_link}")\n',
                               f'    display(IFrame(src=f"{render_link}", width=730, height=410))\n',
                               'display(out)']
-    return content
+
+        self.previous_cell = cell
+        return [cell]
+
+
+def open_in_colab_new_tab(content):
+    return run_transforms(content, [OpenInColabNewTab()])
+
+
+def link_hidden_cells(content):
+    return run_transforms(content, [LinkHiddenCells()])
+
+
+def change_video_widths(content):
+    return run_transforms(content, [ChangeVideoWidths()])
+
+
+def test_set_anchor_targets():
+
+    badge = '<a href="x.ipynb" target="_parent"><img src="badge.svg" alt="Open"/></a>'
+    assert set_anchor_targets(badge) == '<a href="x.ipynb" target="_blank"><img src="badge.svg" alt="Open"/></a>'
+
+    html = "# Title\n<a\n  href='y'\n>y</a> &nbsp; <A HREF=z TARGET>z</A>"
+    assert set_anchor_targets(html) == "# Title\n<a\n  href='y' target=\"_blank\"\n>y</a> &nbsp; <A HREF=z target=\"_blank\">z</A>"
+
+    for malformed in ['<a href="x', '<!-- <a> --><a>', '<a href="x" href="y">']:
+        try:
+            set_anchor_targets(malformed)
+        except ValueError:
+            pass
+        else:
+            assert False, malformed
+
 
 if __name__ == '__main__':
     main()
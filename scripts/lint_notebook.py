@@ -9,133 +9,407 @@ and some checks will false-alarm because of deliberate choices we have made
 about how to write MiniUnits. Nevertheless, this can be an easy way to flag
 potential issues.
 
+Several notebooks can be passed at once; they are linted in parallel and
+reported in order. Use `--format json` to get every problem as a record with
+its cell, line, code and message, e.g. for aggregating over a whole course.
+
 Requires nbformat (part of Jupyter) and flake8.
 
 """
 import os
 import io
-import re
 import sys
+import json
+import bisect
+import itertools
+import hashlib
 import argparse
-import tempfile
-import subprocess
 import collections
+from functools import lru_cache
 import nbformat
+import pycodestyle
 from pyflakes.api import check
 from pyflakes.reporter import Reporter
+from result_cache import CACHE_DIR, load_cache, save_cache, lookup, map_cached
+
+# Maximum number of cached results of each kind to keep between runs
+LINT_CACHE_SIZE = 20000
+
+# Bump when the format of cached results changes
+LINT_CACHE_VERSION = 2
+
+# A problem found in a notebook; cell and line are 1-based positions within
+# the notebook's code cells, and code is a pycodestyle code (e.g. E501) or
+# the name of a pyflakes message class (e.g. UnusedImport)
+Diagnostic = collections.namedtuple(
+    "Diagnostic", ["tool", "cell", "line", "column", "code", "message"]
+)
+
+# pyflakes codes for code that could not be checked at all
+PYFLAKES_ERRORS = {"SyntaxError", "UnexpectedError"}
 
 
 def main(arglist):
 
     args = parse_args(arglist)
 
-    _, fname = os.path.split(args.path)
+    cache_path = args.cache if args.use_cache else None
+    results = lint_notebooks(args.paths, args.jobs, cache_path)
 
-    script, cell_lines = extract_code(args.path)
-    warnings, errors = check_code(script)
-    violations = check_style(script)
+    if args.format == "json":
+        report_json(args.paths, results)
+        return
 
-    if args.brief:
-        report_brief(fname, warnings, errors, violations)
-    else:
-        line_map = remap_line_numbers(cell_lines)
-        report_verbose(fname, warnings, errors, violations, line_map)
+    for path, diagnostics in zip(args.paths, results):
+        _, fname = os.path.split(path)
+        if args.format == "brief":
+            report_brief(fname, diagnostics)
+        else:
+            report_verbose(fname, diagnostics)
 
 
 def parse_args(arglist):
 
     parser = argparse.ArgumentParser(__doc__)
-    parser.add_argument("path", help="Path to notebook file")
-    parser.add_argument("--brief", action="store_true",
-                        help="Print brief report (useful for aggregating)")
+    parser.add_argument("paths", nargs="+", help="Path(s) to notebook file(s)")
+    parser.add_argument("--format", choices=["verbose", "brief", "json"],
+                        default="verbose", help="Report format")
+    parser.add_argument("--brief", action="store_const", const="brief", dest="format",
+                        help="Print brief report (same as --format brief)")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of notebooks to lint in parallel (default: all cores)")
+    parser.add_argument("--cache", default=os.path.join(CACHE_DIR, "lint.json"),
+                        help="Path of the JSON file caching lint results")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache",
+                        help="Lint every cell again rather than reusing cached results")
 
     return parser.parse_args(arglist)
 
 
-def extract_code(nb_fname):
-    """Turn code cells from notebook into a script, track cell sizes."""
+def lint_notebooks(paths, jobs=None, cache_path=None):
+    """Lint several notebooks, spreading them across a pool of processes.
+
+    Results are returned in the order of `paths`; see `lint_notebook`. With a
+    `cache_path`, results for unchanged cells and scripts are reused from (and
+    new ones saved to) a JSON cache file.
+
+    """
+    cache = load_lint_cache(cache_path) if cache_path is not None else None
+
+    results = map_cached(lint_notebook, paths, cache, jobs)
+
+    if cache is not None:
+        save_lint_cache(cache_path, cache)
+
+    return results
+
+
+def lint_notebook(path, cache=None):
+    """Lint a notebook, returning a list of Diagnostic records.
+
+    pyflakes problems come first, then pycodestyle violations, each in the
+    order they were found. If a `cache` dict (see `load_lint_cache`) is given,
+    cached results are reused where possible and new results are added to it.
+
+    """
+    cells = extract_cells(path)
+    script = "\n".join(line for lines in cells for line in lines)
+    if cache is None:
+        problems = check_code(script)
+        violations = check_style(script)
+    else:
+        problems = check_code_cached(script, cache["flakes"])
+        violations = check_style_cells(cells, cache["style"])
+
+    cell_starts = remap_line_numbers([len(lines) for lines in cells])
+    diagnostics = []
+    for line, column, code, message in problems:
+        cell, line = cell_position(cell_starts, line)
+        diagnostics.append(Diagnostic("pyflakes", cell, line, column, code, message))
+    for line, offset, code, text in violations:
+        cell, line = cell_position(cell_starts, line)
+        diagnostics.append(Diagnostic("pycodestyle", cell, line, offset + 1, code, text))
+    return diagnostics
+
+
+def extract_cells(nb_fname):
+    """Return the lines of each code cell, with IPython syntax commented out."""
     with open(nb_fname) as f:
         nb = nbformat.read(f, nbformat.NO_CONVERT)
 
-    script_lines = []
-    cell_lengths = []
+    cells = []
     for cell in nb.get("cells", []):
         if cell["cell_type"] == "code":
-            cell_lines = cell.get("source", "").split("\n")
-            cell_lengths.append(len(cell_lines))
-            for line in cell_lines:
+            cell_lines = []
+            for line in cell.get("source", "").split("\n"):
                 if line and line[0] in ["!", "%"]:  # IPython syntax
                     line = "# " + line
-                script_lines.append(line)
+                cell_lines.append(line)
+            cells.append(cell_lines)
+
+    return cells
+
+
+def extract_code(nb_fname):
+    """Turn code cells from notebook into a script, track cell sizes."""
+    cells = extract_cells(nb_fname)
+    script = "\n".join(line for lines in cells for line in lines)
+    return script, [len(lines) for lines in cells]
 
-    script = "\n".join(script_lines)
 
-    return script, cell_lengths
+class CollectReporter(Reporter):
+    """Collect pyflakes problems as (line, column, code, message) records."""
+
+    def __init__(self):
+        super().__init__(None, None)
+        self.problems = []
+
+    def unexpectedError(self, filename, msg):
+        self.problems.append((None, None, "UnexpectedError", msg))
+
+    def syntaxError(self, filename, msg, lineno, offset, text):
+        column = None if offset is None else max(offset, 1)
+        self.problems.append((max(lineno or 0, 1), column, "SyntaxError", msg))
+
+    def flake(self, message):
+        self.problems.append((
+            message.lineno,
+            message.col + 1,
+            type(message).__name__,
+            message.message % message.message_args,
+        ))
 
 
 def check_code(script):
-    """Run pyflakes checks over the script and capture warnings/errors."""
-    errors = io.StringIO()
-    warnings = io.StringIO()
-    reporter = Reporter(warnings, errors)
+    """Run pyflakes checks over the script, returning problem records."""
+    reporter = CollectReporter()
     check(script, "notebook", reporter)
 
-    warnings.seek(0)
-    errors.seek(0)
+    # List problems with the code before errors about it, as pyflakes would
+    return sorted(reporter.problems, key=lambda p: p[2] in PYFLAKES_ERRORS)
 
-    return warnings, errors
 
+def check_code_cached(script, cache):
+    """Run pyflakes like check_code, caching results by the script's hash.
 
-def check_style(script):
-    """Write a temporary script and run pycodestyle (PEP8) on it."""
+    Names flow between cells, so pyflakes always needs the whole script.
 
-    with tempfile.NamedTemporaryFile("w", suffix=".py") as f:
+    """
+    problems = lookup(cache, hash_text(script), lambda: check_code(script))
+    return [tuple(problem) for problem in problems]
 
-        f.write(script)
 
-        cmdline = [
-            "pycodestyle",
-            "--ignore=E111,E114",
-            "--max-line-length=88",
-            f.name,
-        ]
-        res = subprocess.run(cmdline, capture_output=True)
+class CollectReport(pycodestyle.BaseReport):
+    """Collect pycodestyle violations in memory rather than printing them."""
 
-    output = res.stdout.decode().replace(f.name, "f").split("\n")
+    def __init__(self, options):
+        super().__init__(options)
+        self.violations = []
 
-    if not output:
-        return collections.Counter()
+    def error(self, line_number, offset, text, check):
+        code = super().error(line_number, offset, text, check)
+        if code:
+            self.violations.append((line_number, offset, code, text[5:]))
+        return code
 
-    error_classes = []
-    pat = re.compile(r"^f:\d+:\d+: (\w\d{3}) (.*)$")
-    for line in output:
-        m = pat.match(line)
-        if m is not None:
-            error_classes.append(f"{m.group(1)} ({m.group(2)})")
 
-    return collections.Counter(error_classes)
+@lru_cache(maxsize=None)
+def style_options():
+    """Build the pycodestyle options shared by every check in this process."""
+    style = pycodestyle.StyleGuide(
+        ignore=["E111", "E114"],
+        max_line_length=88,
+        reporter=CollectReport,
+    )
+    return style.options
 
 
-def remap_line_numbers(cell_lines):
-    """Create a mapping from script line number to notebook cell/line."""
-    line_map = {}
+class ResumedChecker(pycodestyle.Checker):
+    """A pycodestyle Checker that starts from the state left by earlier lines.
+
+    Besides the preceding lines themselves, pycodestyle carries the file's
+    indentation character and whether non-import code has been seen yet.
+
+    """
+    def __init__(self, *args, state=(None, False, False), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial_indent_char, seen_non_imports, seen_docstring = state
+        self._checker_states["module_imports_on_top_of_file"] = {
+            "seen_non_imports": seen_non_imports,
+            "seen_docstring": seen_docstring,
+        }
+
+    def readline(self):
+        if self.line_number == 0 and self.indent_char is None:
+            self.indent_char = self.initial_indent_char
+        return super().readline()
+
+    def final_state(self):
+        imports = self._checker_states["module_imports_on_top_of_file"]
+        return (
+            self.indent_char,
+            imports.get("seen_non_imports", False),
+            imports.get("seen_docstring", False),
+        )
+
+
+def style_violations(script, state=(None, False, False)):
+    """Run pycodestyle over a script, returning (line, offset, code, text).
+
+    Also returns the checker state at the end of the script (see ResumedChecker),
+    which `state` can pass on to a check of the lines that follow.
+
+    """
+    options = style_options()
+
+    # Split lines the way they would be read back from a file on disk
+    lines = io.StringIO(script, newline=None).readlines()
+    checker = ResumedChecker(
+        "f", lines=lines, options=options, report=CollectReport(options),
+        state=state,
+    )
+    checker.check_all()
+
+    return sorted(checker.report.violations), checker.final_state()
+
+
+def check_style(script):
+    """Run pycodestyle (PEP8) over the script in memory.
+
+    Returns (line, offset, code, text) records in file order.
+
+    """
+    violations, _ = style_violations(script)
+    return violations
+
+
+def check_style_cells(cells, cache):
+    """Run pycodestyle cell by cell, reusing cached results for unchanged cells.
+
+    Blank-line checks depend on the code before a cell, so each cell is checked
+    after the preceding cells back to the last one with a top-level statement,
+    starting from the checker state left before them. The cache is keyed on
+    all of that as well as the cell itself. Results are stored with line
+    numbers relative to the cell and shifted back to their position in the
+    script.
+
+    """
+    states = [(None, False, False)]  # Checker state before each cell
+    violations = []
     cell_start = 0
-    for cell, cell_length in enumerate(cell_lines, 1):
-        for line in range(1, cell_length + 1):
-            line_map[cell_start + line] = cell, line
-        cell_start += cell_length
-    return line_map
+    for i, lines in enumerate(cells):
+        start = style_context_start(cells, i)
+        context = [line for cell_lines in cells[start:i] for line in cell_lines]
+        # The script ends after this cell, or after an empty last cell
+        # that adds no line of its own
+        at_end = i == len(cells) - 1 or (i == len(cells) - 2 and cells[-1] == [""])
+        is_last = i == len(cells) - 1
+        key = hash_text(json.dumps([states[start], context, lines, is_last, at_end]))
+        cell_violations, state = lookup(
+            cache, key,
+            lambda: check_cell_style(states[start], context, lines, is_last, at_end),
+        )
+        for line, offset, code, text in cell_violations:
+            if code in ("E901", "E902"):
+                # A tokenizer error can swallow the cells after it, so these
+                # can only be reproduced by checking the whole script
+                return check_style("\n".join(line for ls in cells for line in ls))
+            violations.append((cell_start + line, offset, code, text))
+        states.append(tuple(state))
+        cell_start += len(lines)
+    return sorted(violations)
+
+
+def style_context_start(cells, i):
+    """Return the index of the first cell before cell i affecting its checks."""
+    start = i
+    while start > 0:
+        start -= 1
+        if any(line[:1] not in ("", " ", "\t", "#") for line in cells[start]):
+            break
+    return start
+
+
+def check_cell_style(state, context, lines, is_last, at_end):
+    """Check one cell's lines after their context, with cell-relative lines."""
+    # Cells other than the last are followed by a newline in the script
+    script = "\n".join(context + lines) + ("" if is_last else "\n")
+    violations, final_state = style_violations(script, state)
+    n = len(context)
+    violations = [
+        (line - n, offset, code, text)
+        for line, offset, code, text in violations
+        if line > n and (at_end or code != "W391")
+    ]
+    return violations, final_state
+
+
+def test_check_style_cells():
+
+    cells = [
+        ["import os", "x=1"],
+        ["def f():", "    return 1"],
+        ["# A comment", ""],
+        ["import sys", "print( f() )", "", ""],
+        [""],
+    ]
+    script = "\n".join(line for lines in cells for line in lines)
+    expected = check_style(script)
+
+    cache = {}
+    assert check_style_cells(cells, cache) == expected
+    assert check_style_cells(cells, cache) == expected
+
+    # Editing a cell re-checks it and the cells that depend on it
+    cells[1] = ["def f():", "\treturn 1"]
+    script = "\n".join(line for lines in cells for line in lines)
+    assert check_style_cells(cells, cache) == check_style(script)
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_lint_cache(path):
+    """Load cached pycodestyle results per cell and pyflakes results per script."""
+    return load_cache(path, LINT_CACHE_VERSION, ("style", "flakes"))
+
+
+def save_lint_cache(path, cache):
+    """Atomically write the cache, keeping the most recently used entries."""
+    save_cache(path, cache, LINT_CACHE_VERSION, LINT_CACHE_SIZE)
+
+
+def remap_line_numbers(cell_lines):
+    """Return the script line number before each cell (a prefix sum of lengths)."""
+    return list(itertools.accumulate(cell_lines, initial=0))
+
 
+def cell_position(cell_starts, line):
+    """Map a script line number to a notebook (cell, line) pair."""
+    if line is None:
+        return None, None
+    cell = min(max(bisect.bisect_left(cell_starts, line), 1), len(cell_starts) - 1)
+    return cell, line - cell_starts[cell - 1]
 
-def report_brief(fname, warnings, errors, violations):
+
+def report_brief(fname, diagnostics):
     """Print a single-line report, suibtable for aggregation."""
-    n_warnings = len(warnings.read().splitlines())
-    n_errors = len(errors.read().splitlines())
-    n_violations = len(list(violations.elements()))
-    print(f"{fname} {n_warnings + n_errors} {n_violations}")
+    n_issues = sum(d.tool == "pyflakes" for d in diagnostics)
+    n_violations = sum(d.tool == "pycodestyle" for d in diagnostics)
+    print(f"{fname} {n_issues} {n_violations}")
+
 
+def report_json(paths, results):
+    """Print every diagnostic for each notebook as JSON records."""
+    report = {
+        path: [d._asdict() for d in diagnostics]
+        for path, diagnostics in zip(paths, results)
+    }
+    print(json.dumps(report, indent=4))
 
-def report_verbose(fname, warnings, errors, violations, line_map):
+
+def report_verbose(fname, diagnostics):
     """Report every pyflakes problem and more codestyle information."""
     s = f"Code report for {fname}"
     print("", s, "=" * len(s), sep="\n")
@@ -143,18 +417,21 @@ def report_verbose(fname, warnings, errors, violations, line_map):
     s = "Quality (pyflakes)"
     print("", s, "-" * len(s), "", sep="\n")
 
-    warning_lines = reformat_line_problems(warnings, line_map)
-    error_lines = reformat_line_problems(errors, line_map, "ERROR in ")
-
-    issues = warning_lines + error_lines
+    issues = [
+        format_problem(d, "ERROR in " if d.code in PYFLAKES_ERRORS else "")
+        for d in diagnostics if d.tool == "pyflakes"
+    ]
     print(f"Total code issues: {len(issues)}")
     if issues:
         print()
-        print("\n".join(warning_lines + error_lines))
+        print("\n".join(issues))
 
     s = "Style (pycodestyle)"
     print("", s, "-" * len(s), "", sep="\n")
 
+    violations = collections.Counter(
+        f"{d.code} ({d.message})" for d in diagnostics if d.tool == "pycodestyle"
+    )
     n = len(list(violations.elements()))
     print(f"Total PEP8 violations: {n}")
 
@@ -169,22 +446,11 @@ def report_verbose(fname, warnings, errors, violations, line_map):
     print("")
 
 
-def reformat_line_problems(stream, line_map, prefix=""):
-    """Reformat a pyflakes output stream for notebook cells."""
-    pat = re.compile(r"^\w*:(\d+):\d+ (.+)$")
-
-    new_lines = []
-    orig_lines = stream.read().splitlines()
-
-    for line in orig_lines:
-        m = pat.match(line)
-        if m:
-            cell, line = line_map[int(m.group(1))]
-            new_lines.append(
-                f"{prefix}Cell {cell}, Line {line}: {m.group(2)}"
-            )
-
-    return new_lines
+def format_problem(diagnostic, prefix=""):
+    """Describe a pyflakes problem by its notebook cell and line."""
+    if diagnostic.cell is None:
+        return f"{prefix}{diagnostic.message}"
+    return f"{prefix}Cell {diagnostic.cell}, Line {diagnostic.line}: {diagnostic.message}"
 
 
 if __name__ == "__main__":
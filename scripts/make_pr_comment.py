@@ -4,10 +4,14 @@
 - Run the code linter over the notebooks and include the report
 
 """
+import io
 import os
 import sys
 import argparse
-import subprocess
+import traceback
+from contextlib import redirect_stdout
+import lint_notebook
+from result_cache import map_cached
 
 REPO = os.environ.get("C4R_REPO", "default-repo")
 
@@ -20,15 +24,18 @@ def main(arglist):
         make_colab_badge_table(args.branch, args.notebooks),
     ]
 
+    # Lint all notebooks in one batch
+    lint_results = map_cached(lint_notebook_job, args.notebooks)
+
     # Add a code report (under a details tag) for each notebook
-    for nb_fpath in args.notebooks:
+    for nb_fpath, (diagnostics, error) in zip(args.notebooks, lint_results):
         _, nb_fname = os.path.split(nb_fpath)
         nb_name, _ = os.path.splitext(nb_fname)
         comment_lines.extend([
             "\n"
             "<details>",
             f"<summary><i>Code report for {nb_name}</i></summary>",
-            make_lint_report(nb_fpath),
+            make_lint_report(nb_fpath, diagnostics, error),
             "---",
             "",
             "</details>",
@@ -43,11 +50,26 @@ def main(arglist):
             fid.write(comment)
 
 
-def make_lint_report(nb_fpath):
-    """Run the notebook linter on a notebook and capture the output."""
-    cmdline = ["python", "ci/lint_notebook.py", nb_fpath]
-    res = subprocess.run(cmdline, capture_output=True)
-    return res.stdout.decode()
+def lint_notebook_job(nb_fpath, cache):
+    """Lint a notebook, returning (diagnostics, None), or (None, traceback) if the linter fails.
+
+    A failure is kept to its own notebook rather than aborting the whole comment.
+    """
+    try:
+        return lint_notebook.lint_notebook(nb_fpath, cache), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def make_lint_report(nb_fpath, diagnostics, error=None):
+    """Format the linter results for a notebook as a verbose report."""
+    _, nb_fname = os.path.split(nb_fpath)
+    if error is not None:
+        return f"\nCould not lint {nb_fname}:\n\n```\n{error}```\n"
+    report = io.StringIO()
+    with redirect_stdout(report):
+        lint_notebook.report_verbose(nb_fname, diagnostics)
+    return report.getvalue()
 
 
 def make_colab_badge_table(branch, notebooks):
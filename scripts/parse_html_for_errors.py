@@ -1,45 +1,157 @@
-import yaml
+import os
 import sys
-from bs4 import BeautifulSoup
+import html
+import shutil
+import tempfile
+from functools import partial
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+
+# Number of pages to process in parallel
+JOBS = int(os.environ.get("C4R_BOOK_JOBS", os.cpu_count() or 1))
+
+# Pages are streamed through the filter in chunks of this many characters
+CHUNK_SIZE = 1 << 16
+
+# Code outputs are dropped if they contain one of these errors
+OUTPUT_CLASS = "cell_output docutils container"
+OUTPUT_ERRORS = ("NotImplementedError", "NameError")
 
-ARG = sys.argv[1]
 
 def main():
+    # Which version of the notebooks was built (e.g. student or instructor)
+    version = sys.argv[1]
+
     with open('units/materials.yml') as fh:
         materials = yaml.load(fh, Loader=yaml.FullLoader)
 
     html_directory = 'book/_build/html/'
 
-    # Loop over units
+    # Collect the html files of the MiniUnits of all units
+    page_paths = []
     for m in materials:
         name = f"{m['unit']}_{''.join(m['name'].split())}"
-
-        # Loop over MiniUnits
         for i in range(m['MiniUnits']):
+            page_paths.append(f"{html_directory}/units/{name}/{version}/{m['unit']}_MiniUnit{i + 1}.html")
+
+    if JOBS > 1 and len(page_paths) > 1:
+        with ProcessPoolExecutor(min(JOBS, len(page_paths))) as pool:
+            list(pool.map(process_page, page_paths))
+    else:
+        for page_path in page_paths:
+            process_page(page_path)
+
+
+def process_page(path):
+    """Filter an html page in place, replacing it atomically once done."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with open(path, newline="") as src, os.fdopen(fd, "w", newline="") as dst:
+            page_filter = PageFilter(dst.write)
+            for chunk in iter(partial(src.read, CHUNK_SIZE), ""):
+                page_filter.feed(chunk)
+            page_filter.close()
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class PageFilter(HTMLParser):
+    """Stream an html page, dropping error outputs and centering solution figures.
+
+    Everything else is written out exactly as it was read. Only the code
+    output being read is held in memory, to decide whether to keep it.
+    """
+
+    def __init__(self, write):
+        super().__init__(convert_charrefs=False)
+        self.write = write
+        self.replacement = None
+        self.output = None
+        self.output_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div':
+            if self.output is not None:
+                self.output_depth += 1
+            elif " ".join((dict(attrs).get('class') or "").split()) == OUTPUT_CLASS:
+                self.output = []
+                self.output_depth = 1
+        elif tag == 'img' and dict(attrs).get('alt') == 'Solution hint':
+            # Put solution figures in center (to fix layout issues)
+            self.replacement = center_image(self.get_starttag_text(), attrs)
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.output is not None:
+            self.output_depth -= 1
+
+    def updatepos(self, i, j):
+        # The parser calls this as it consumes each tag or piece of text,
+        # right after the handler, so the raw text can be passed on here
+        if i < j:
+            text = self.rawdata[i:j] if self.replacement is None else self.replacement
+            self.replacement = None
+            if self.output is None:
+                self.write(text)
+            else:
+                self.output.append(text)
+                if not self.output_depth:
+                    self.end_output()
+        return super().updatepos(i, j)
+
+    def close(self):
+        super().close()
+        if self.output is not None:
+            self.end_output()
+
+    def end_output(self):
+        output = "".join(self.output)
+        self.output = None
+        # Remove div if it has an error
+        if not any(error in output for error in OUTPUT_ERRORS):
+            self.write(output)
+
+
+def center_image(tag_text, attrs):
+    """Rebuild an img start tag so it is aligned to the center."""
+    attrs = dict(attrs)
+    attrs['align'] = 'center'
+    attrs['class'] = 'align-center'
+    attr_text = "".join(
+        f' {name}' if value is None else f' {name}="{html.escape(value)}"'
+        for name, value in attrs.items()
+    )
+    return f"<img{attr_text}{'/>' if tag_text.endswith('/>') else '>'}"
+
+
+def test_page_filter():
+
+    page = (
+        '<body>\n<div class="cell docutils container">'
+        '<div class="cell_output docutils container"><div class="output"><pre>'
+        '<span class="ne">NotImplementedError</span>: &lt;todo&gt;</pre></div></div>'
+        '<div class="cell_output docutils container"><pre>42</pre><br></div>'
+        "<img src='hint.png' alt='Solution hint' class=\"x\"><IMG src=a.png alt=Other>"
+        '</div>\n</body>\n'
+    )
+    expected = (
+        '<body>\n<div class="cell docutils container">'
+        '<div class="cell_output docutils container"><pre>42</pre><br></div>'
+        '<img src="hint.png" alt="Solution hint" class="align-center" align="center"><IMG src=a.png alt=Other>'
+        '</div>\n</body>\n'
+    )
 
-            # Load html file
-            notebook_file_path = f"{html_directory}/units/{name}/{ARG}/{m['unit']}_MiniUnit{i + 1}.html"
-            with open(notebook_file_path, 'r') as f:
-                contents = f.read()
-            parsed_html = BeautifulSoup(contents, features="html.parser")
-
-            # Find code output divs
-            mydivs = parsed_html.find_all("div", {"class": "cell_output docutils container"})
-
-            # Remove div if it has an error
-            for div in mydivs:
-                if 'NotImplementedError' in str(div) or 'NameError' in str(div):
-                    div.decompose()
-
-            # Put solution figures in center (to fix layout issues) 
-            for img in parsed_html.find_all('img', alt= True):
-                if img['alt'] == 'Solution hint':
-                    img['align'] = 'center'
-                    img['class'] = 'align-center'
-                    
-            # save out html
-            with open(notebook_file_path, 'w') as f:
-                f.write(str(parsed_html))
+    # The result does not depend on where the page is split into chunks
+    for chunk_size in [1, 7, len(page)]:
+        written = []
+        page_filter = PageFilter(written.append)
+        for start in range(0, len(page), chunk_size):
+            page_filter.feed(page[start:start + chunk_size])
+        page_filter.close()
+        assert "".join(written) == expected
 
 
 if __name__ == '__main__':
@@ -22,15 +22,27 @@
 import os
 import re
 import sys
+import ast
+import json
 import argparse
+import time
+import struct
 import hashlib
-from io import BytesIO
+import shutil
+import tempfile
+from collections import deque
+from difflib import SequenceMatcher
+from functools import partial, lru_cache
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.util import Finalize
 from binascii import a2b_base64
-from copy import deepcopy
+from copy import copy, deepcopy
 
-from PIL import Image
 import nbformat
 from nbconvert.preprocessors import ExecutePreprocessor
+from jupyter_client import KernelManager
+from result_cache import CACHE_DIR, write_json
 
 REPO = os.environ.get("C4R_REPO", "sample-publishing")
 MAIN_BRANCH = os.environ.get("C4R_MAIN_BRANCH", "main")
@@ -42,6 +54,68 @@ GITHUB_TREE_URL = (
     f"https://github.com/c4r-io/{REPO}/tree/{MAIN_BRANCH}"
 )
 
+MANIFEST_FNAME = ".c4r_manifest.json"
+
+SEQUENTIAL_ERROR = (
+    "Notebook is not sequentially executed on a fresh kernel."
+    "\n"
+    "Please do 'Restart and run all' before pushing to Github."
+)
+
+UNEXECUTED_ERROR = "Notebook has unexecuted code cell(s)."
+
+# Calls whose effects on the kernel state cannot be tracked by name
+OPAQUE_CALLS = {
+    "exec", "eval", "compile", "globals", "locals", "vars", "open",
+    "__import__", "setattr", "delattr", "get_ipython",
+}
+
+# Kernels kept alive between notebooks with --warm-kernels, by kernel name
+WARM_KERNELS = {}
+
+# Preload modules and remember the state that is restored between notebooks
+WARM_KERNEL_CODE = """
+import os, sys, importlib
+for _name in {imports!r}:
+    try:
+        importlib.import_module(_name.strip())
+    except ImportError:
+        pass
+_shell = get_ipython()
+_shell._c4r_cwd = os.getcwd()
+_shell._c4r_path = list(sys.path)
+_shell._c4r_environ = dict(os.environ)
+if "matplotlib" in sys.modules:
+    _shell._c4r_rcparams = dict(sys.modules["matplotlib"].rcParams)
+del _name, _shell
+get_ipython().reset(new_session=True, aggressive=False)
+"""
+
+# Give the next notebook a fresh namespace without unloading imported modules,
+# restoring the process state and module state that notebooks commonly change.
+# Fails (so that the kernel is discarded) if that state cannot be restored.
+RESET_KERNEL_CODE = """
+import os, sys
+_shell = get_ipython()
+os.chdir(_shell._c4r_cwd)
+sys.path[:] = _shell._c4r_path
+os.environ.clear()
+os.environ.update(_shell._c4r_environ)
+# Fresh kernels seed their random number generators from the OS
+if "random" in sys.modules:
+    sys.modules["random"].seed()
+if "numpy.random" in sys.modules:
+    sys.modules["numpy.random"].seed()
+if "matplotlib.pyplot" in sys.modules:
+    sys.modules["matplotlib.pyplot"].close("all")
+if "matplotlib" in sys.modules:
+    if not hasattr(_shell, "_c4r_rcparams"):
+        raise RuntimeError("matplotlib was first imported after warm-up")
+    dict.update(sys.modules["matplotlib"].rcParams, _shell._c4r_rcparams)
+del _shell
+get_ipython().reset(new_session=True, aggressive=False)
+"""
+
 
 def main(arglist):
     """Process IPython notebooks from a list of files."""
@@ -73,148 +147,934 @@ def main(arglist):
         exec_kws["kernel_name"] = os.environ["NB_KERNEL"]
 
     # Defer failures until after processing all notebooks
-    notebooks = {}
     errors = {}
 
-    for nb_path in nb_paths:
-
-        # Load the notebook structure
-        with open(nb_path) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
-
-        if not sequentially_executed(nb):
-            if args.require_sequential:
-                err = (
-                    "Notebook is not sequentially executed on a fresh kernel."
-                    "\n"
-                    "Please do 'Restart and run all' before pushing to Github."
-                )
-                errors[nb_path] = err
-                continue
+    if args.fast_check:
+        allow_error_names = exec_kws["allow_error_names"]
+        for nb_path in nb_paths:
+            print(f"Fast checking {nb_path}")
+            error = fast_check(nb_path, args.require_sequential, allow_error_names)
+            if error is not None:
+                errors[nb_path] = error
+        exit(errors)
 
-        # Clean whitespace from all code cells
-        clean_whitespace(nb)
+    prepare = partial(prepare_notebook, args=args, exec_kws=exec_kws)
+    if args.memory_budget is not None:
+        stream_notebooks(prepare, nb_paths, args)
 
-        # Ensure that we have an executed notebook, in one of two ways
-        executor = ExecutePreprocessor(**exec_kws)
-        if args.execute:
-            # Check dynamically by executing and reporting errors
-            print(f"Executing {nb_path}")
-            error = execute_notebook(executor, nb, args.raise_fast)
-        elif args.check_execution:
-            # Check statically by examining the cell outputs
-            print(f"Checking {nb_path} execution")
-            error = check_execution(executor, nb, args.raise_fast)
-        else:
-            error = None
+    # Load, check and execute the notebooks, optionally in parallel. Results
+    # are collected in input order so that reporting stays deterministic.
+    if args.jobs > 1 and not args.raise_fast:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            results = list(pool.map(prepare, nb_paths))
+    else:
+        results = map(prepare, nb_paths)
 
+    notebooks = {}
+    profiles = {}
+    for nb_path, (nb, error, timings) in zip(nb_paths, results):
         if error is None:
             notebooks[nb_path] = nb
         else:
             errors[nb_path] = error
+        if timings is not None:
+            profiles[nb_path] = timings
+
+    # Keep the execution cache within its size budget
+    if args.execute and args.use_cache:
+        evict_cache(execution_cache_dir(args), args.cache_size * 2 ** 20)
+
+    if args.profile is not None:
+        report_profiles(profiles, args.profile, args.profile_top)
 
     if errors or args.check_only:
         exit(errors)
 
-    # Post-process notebooks
+    # Post-process notebooks, tracking derived artifacts in a per-directory
+    # manifest so that unchanged notebooks are not regenerated
+    manifests = {}
     for nb_path, nb in notebooks.items():
+        post_process_notebook(nb_path, nb, manifests, write_if_changed)
 
-        # Extract components of the notebook path
-        nb_dir, nb_fname = os.path.split(nb_path)
-        nb_name, _ = os.path.splitext(nb_fname)
-
-        # Loop through the cells and fix any Colab badges we encounter
-        for cell in nb.get("cells", []):
-            if has_colab_badge(cell):
-                redirect_colab_badge_to_main_branch(cell)
-                # add kaggle badge
-                add_kaggle_badge(cell, nb_path)
-
-        # Ensure that Colab metadata dict exists and enforce some settings
-        add_colab_metadata(nb, nb_name)
-
-        # Write the original notebook back to disk, clearing outputs only for units
-        print(f"Writing complete notebook to {nb_path}")
-        with open(nb_path, "w") as f:
-            nb_clean = clean_notebook(nb, clear_outputs=nb_path.startswith("units"))
-            nbformat.write(nb_clean, f)
-
-        # if the notebook is not in units, skip the creation/update of the student, static, solutions directories
-        if not nb_path.startswith("units"):
-          continue
-
-        # Create subdirectories, if they don't exist
-        student_dir = make_sub_dir(nb_dir, "student")
-        static_dir = make_sub_dir(nb_dir, "static")
-        solutions_dir = make_sub_dir(nb_dir, "solutions")
-        instructor_dir = make_sub_dir(nb_dir, "instructor")
-
-        # Generate the student version and save it to a subdirectory
-        print(f"Extracting solutions from {nb_path}")
-        processed = extract_solutions(nb, nb_dir, nb_name)
-        student_nb, static_images, solution_snippets = processed
-        
-        # Generate the instructor version and save it to a subdirectory
-        print(f"Create instructor notebook from {nb_path}")
-        instructor_nb = instructor_version(nb, nb_dir, nb_name)
-
-        # Loop through cells and point the colab badge at the student version
-        for cell in student_nb.get("cells", []):
-            if has_colab_badge(cell):
-                redirect_colab_badge_to_student_version(cell)
-                # add kaggle badge
-                add_kaggle_badge(cell, nb_path)
-
-        # Loop through cells and point the colab badge at the instructor version
-        for cell in instructor_nb.get("cells", []):
-            if has_colab_badge(cell):
-                redirect_colab_badge_to_instructor_version(cell)
-                # add kaggle badge
-                add_kaggle_badge(cell, nb_path)
-
-        # Write the student version of the notebook
-        student_nb_path = os.path.join(student_dir, nb_fname)
-        print(f"Writing student notebook to {student_nb_path}")
-        with open(student_nb_path, "w") as f:
-            clean_student_nb = clean_notebook(student_nb)
-            nbformat.write(clean_student_nb, f)
-
-        # Write the images extracted from the solution cells
-        print(f"Writing solution images to {static_dir}")
-        for fname, image in static_images.items():
-            fname = fname.replace("static", static_dir)
-            image.save(fname)
-
-        # Write the solution snippets
-        print(f"Writing solution snippets to {solutions_dir}")
-        for fname, snippet in solution_snippets.items():
-            fname = fname.replace("solutions", solutions_dir)
-            with open(fname, "w") as f:
-                f.write(snippet)
-
-        # Write the instructor version of the notebook
-        instructor_nb_path = os.path.join(instructor_dir, nb_fname)
-        print(f"Writing instructor notebook to {instructor_nb_path}")
-        with open(instructor_nb_path, "w") as f:
-            clean_instructor_nb = clean_notebook(instructor_nb)
-            nbformat.write(clean_instructor_nb, f)
+    for nb_dir, manifest in manifests.items():
+        save_manifest(nb_dir, manifest, write_if_changed)
 
     exit(errors)
 
 
 # ------------------------------------------------------------------------------------ #
 
-def execute_notebook(executor, nb, raise_fast):
+def post_process_notebook(nb_path, nb, manifests, write):
+    """Write the processed notebook and its derived versions with write(path, data).
+
+    manifests maps unit directories to their loaded manifests and is updated
+    with the artifacts derived from this notebook.
+    """
+    # Extract components of the notebook path
+    nb_dir, nb_fname = os.path.split(nb_path)
+    nb_name, _ = os.path.splitext(nb_fname)
+
+    # Fingerprint the notebook before it is modified below
+    source_hash = notebook_hash(nb)
+
+    # Loop through the cells and fix any Colab badges we encounter
+    for cell in nb.get("cells", []):
+        if has_colab_badge(cell):
+            redirect_colab_badge_to_main_branch(cell)
+            # add kaggle badge
+            add_kaggle_badge(cell, nb_path)
+
+    # Ensure that Colab metadata dict exists and enforce some settings
+    add_colab_metadata(nb, nb_name)
+
+    # Write the original notebook back to disk, clearing outputs only for units
+    print(f"Writing complete notebook to {nb_path}")
+    nb_clean = clean_notebook(nb, clear_outputs=nb_path.startswith("units"))
+    write(nb_path, notebook_bytes(nb_clean))
+
+    # if the notebook is not in units, skip the creation/update of the student, static, solutions directories
+    if not nb_path.startswith("units"):
+        return
+
+    # Skip the derived notebooks if neither they nor their source changed
+    if nb_dir not in manifests:
+        manifests[nb_dir] = load_manifest(nb_dir)
+    manifest = manifests[nb_dir]
+    if artifacts_up_to_date(nb_dir, manifest.get(nb_fname), source_hash):
+        print(f"Skipping unchanged derived notebooks for {nb_path}")
+        return
+
+    artifacts = {}
+
+    def write_artifact(path, data):
+        artifacts[os.path.relpath(path, nb_dir)] = hashlib.sha256(data).hexdigest()
+        write(path, data)
+
+    # Subdirectories are created as needed when writing
+    student_dir = os.path.join(nb_dir, "student")
+    static_dir = os.path.join(nb_dir, "static")
+    solutions_dir = os.path.join(nb_dir, "solutions")
+    instructor_dir = os.path.join(nb_dir, "instructor")
+
+    # Generate the student version and save it to a subdirectory
+    print(f"Extracting solutions from {nb_path}")
+    processed = extract_solutions(nb, nb_dir, nb_name)
+    student_nb, static_images, solution_snippets = processed
+
+    # Generate the instructor version and save it to a subdirectory
+    print(f"Create instructor notebook from {nb_path}")
+    instructor_nb = instructor_version(nb, nb_dir, nb_name)
+
+    # Loop through cells and point the colab badge at the student version
+    for i, cell in enumerate(student_nb.get("cells", [])):
+        if has_colab_badge(cell):
+            cell = student_nb["cells"][i] = copy_cell(cell)
+            redirect_colab_badge_to_student_version(cell)
+            # add kaggle badge
+            add_kaggle_badge(cell, nb_path)
+
+    # Loop through cells and point the colab badge at the instructor version
+    for i, cell in enumerate(instructor_nb.get("cells", [])):
+        if has_colab_badge(cell):
+            cell = instructor_nb["cells"][i] = copy_cell(cell)
+            redirect_colab_badge_to_instructor_version(cell)
+            # add kaggle badge
+            add_kaggle_badge(cell, nb_path)
+
+    # Write the student version of the notebook
+    student_nb_path = os.path.join(student_dir, nb_fname)
+    print(f"Writing student notebook to {student_nb_path}")
+    clean_student_nb = clean_notebook(student_nb)
+    write_artifact(student_nb_path, notebook_bytes(clean_student_nb))
+
+    # Write the images extracted from the solution cells
+    print(f"Writing solution images to {static_dir}")
+    for fname, image_data in static_images.items():
+        fname = fname.replace("static", static_dir)
+        write_artifact(fname, image_data)
+
+    # Write the solution snippets
+    print(f"Writing solution snippets to {solutions_dir}")
+    for fname, snippet in solution_snippets.items():
+        fname = fname.replace("solutions", solutions_dir)
+        write_artifact(fname, snippet.encode("utf-8"))
+
+    # Write the instructor version of the notebook
+    instructor_nb_path = os.path.join(instructor_dir, nb_fname)
+    print(f"Writing instructor notebook to {instructor_nb_path}")
+    clean_instructor_nb = clean_notebook(instructor_nb)
+    write_artifact(instructor_nb_path, notebook_bytes(clean_instructor_nb))
+
+    manifest[nb_fname] = {"source": source_hash, "artifacts": artifacts}
+
+
+def stream_notebooks(prepare, nb_paths, args):
+    """Execute and post-process notebooks one at a time, then exit.
+
+    Each notebook is released as soon as its outputs have been written to a
+    staging directory. The staged files are moved into place only if every
+    notebook passed, preserving the all-or-nothing behavior of the default mode.
+    """
+    errors = {}
+    profiles = {}
+    manifests = {}
+    staging_dir = tempfile.mkdtemp(prefix=".c4r_staging_", dir=".")
+    staged = {}
+
+    def stage(path, data):
+        staged_path = os.path.join(staging_dir, str(len(staged)))
+        with open(staged_path, "wb") as f:
+            f.write(data)
+        staged[path] = staged_path
+
+    try:
+        budget = args.memory_budget * 2 ** 20
+        results = prepare_notebooks_bounded(prepare, nb_paths, args, budget)
+        for nb_path, (nb, error, timings) in results:
+            if error is not None:
+                errors[nb_path] = error
+            elif not (errors or args.check_only):
+                post_process_notebook(nb_path, nb, manifests, stage)
+            if timings is not None:
+                profiles[nb_path] = timings
+            del nb
+
+        if args.execute and args.use_cache:
+            evict_cache(execution_cache_dir(args), args.cache_size * 2 ** 20)
+
+        if args.profile is not None:
+            report_profiles(profiles, args.profile, args.profile_top)
+
+        if not (errors or args.check_only):
+            for nb_dir, manifest in manifests.items():
+                save_manifest(nb_dir, manifest, stage)
+            print(f"Committing {len(staged)} staged files")
+            for path, staged_path in staged.items():
+                commit_file(path, staged_path)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    exit(errors)
+
+
+def prepare_notebooks_bounded(prepare, nb_paths, args, budget):
+    """Yield (nb_path, prepare(nb_path)) in order with a bounded amount of work in flight.
+
+    Finished notebooks waiting to be yielded are charged with their serialized
+    size, measured by the worker, and running ones with the largest size seen
+    so far (or their file size until one has finished). A notebook is only
+    started while the total stays within the budget, and at most `jobs` run at
+    once; at least one notebook is always in flight.
+    """
+    if args.jobs <= 1 or args.raise_fast:
+        for nb_path in nb_paths:
+            yield nb_path, prepare(nb_path)
+        return
+
+    todo = deque(nb_paths)
+    pending = deque()
+    largest = 0
+
+    def charge(nb_path, future):
+        if future.done() and future.exception() is None:
+            return future.result()[1]
+        return max(largest, os.path.getsize(nb_path))
+
+    with ProcessPoolExecutor(args.jobs) as pool:
+        while todo or pending:
+            running = [future for _, future in pending if not future.done()]
+            in_flight = sum(charge(nb_path, future) for nb_path, future in pending)
+            if todo and (not pending or (
+                len(running) < args.jobs
+                and in_flight + max(largest, os.path.getsize(todo[0])) <= budget
+            )):
+                nb_path = todo.popleft()
+                pending.append((nb_path, pool.submit(prepare_and_measure, prepare, nb_path)))
+                continue
+
+            nb_path, future = pending[0]
+            if not future.done():
+                wait(running, return_when=FIRST_COMPLETED)
+                for _, future in pending:
+                    if future.done() and future.exception() is None:
+                        largest = max(largest, future.result()[1])
+                continue
+
+            pending.popleft()
+            result, size = future.result()
+            largest = max(largest, size)
+            yield nb_path, result
+
+
+def prepare_and_measure(prepare, nb_path):
+    """Return prepare(nb_path) and the serialized size of the notebook it returns."""
+    result = prepare(nb_path)
+    nb = result[0]
+    return result, len(nbformat.writes(nb)) if nb is not None else 0
+
+
+def commit_file(path, staged_path):
+    """Move a staged file into place unless the destination is identical."""
+    with open(staged_path, "rb") as f:
+        data = f.read()
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    os.replace(staged_path, path)
+
+
+def prepare_notebook(nb_path, args, exec_kws):
+    """Load, check and optionally execute a notebook.
+
+    Returns (nb, error, timings), where timings holds per-cell measurements
+    when the notebook was executed with profiling enabled.
+    """
+    # Load the notebook structure
+    with open(nb_path) as f:
+        nb = nbformat.read(f, nbformat.NO_CONVERT)
+
+    if not sequentially_executed(nb):
+        if args.require_sequential:
+            return None, SEQUENTIAL_ERROR, None
+
+    # Clean whitespace from all code cells
+    clean_whitespace(nb)
+
+    # Ensure that we have an executed notebook, in one of two ways
+    if args.profile is not None:
+        executor = ProfilingExecutePreprocessor(**exec_kws)
+    else:
+        executor = ExecutePreprocessor(**exec_kws)
+    timings = None
+    if args.execute:
+        # Check dynamically by executing and reporting errors,
+        # unless we have outputs from an identical earlier execution
+        cache_key = None
+        if args.use_cache:
+            cache_dir = execution_cache_dir(args)
+            kernel_name = notebook_kernel_name(nb, executor.kernel_name)
+            cache_key = execution_cache_key(nb, kernel_name)
+        if cache_key is not None and load_cached_outputs(cache_dir, cache_key, nb):
+            print(f"Using cached execution of {nb_path}", flush=True)
+            error = None
+        else:
+            print(f"Executing {nb_path}", flush=True)
+            if args.incremental and cache_key is not None:
+                error = execute_notebook_incremental(
+                    executor, nb, args, cache_dir, nb_path, kernel_name
+                )
+            else:
+                error = run_notebook(executor, nb, args)
+            timings = getattr(executor, "cell_timings", None)
+            if error is None and cache_key is not None:
+                store_cached_outputs(cache_dir, cache_key, nb)
+        if error is None and cache_key is not None and args.incremental:
+            store_cell_record(cache_dir, nb_path, kernel_name, nb)
+    elif args.check_execution:
+        # Check statically by examining the cell outputs
+        print(f"Checking {nb_path} execution", flush=True)
+        error = check_execution(executor, nb, args.raise_fast)
+    else:
+        error = None
+
+    if error is not None:
+        return None, error, timings
+    return nb, None, timings
+
+
+def notebook_kernel_name(nb, kernel_name=""):
+    """Return the kernel that will execute nb, as ExecutePreprocessor chooses it."""
+    if not kernel_name:
+        kernel_name = nb.metadata.get("kernelspec", {}).get("name", "python")
+    return kernel_name
+
+
+def execute_notebook(executor, nb, raise_fast, km=None):
     """Execute the notebook, returning errors to be handled."""
     try:
-        executor.preprocess(nb)
+        executor.preprocess(nb, km=km)
     except Exception as error:
         if raise_fast:
             # Exit here (useful for debugging)
             raise error
         else:
-            # Raise the error to be handled by the caller
-            return error
+            # Return the formatted error to be handled by the caller. Errors
+            # may cross a process boundary, and exceptions do not always
+            # survive pickling with their ename and evalue intact.
+            return str(error)
+
+
+class ProfilingExecutePreprocessor(ExecutePreprocessor):
+    """Execute notebooks while recording wall time and kernel memory per cell."""
+
+    def preprocess(self, nb, resources=None, km=None):
+        self.cell_timings = []
+        return super().preprocess(nb, resources, km)
+
+    def preprocess_cell(self, cell, resources, index):
+        if cell["cell_type"] != "code" or not cell["source"]:
+            return super().preprocess_cell(cell, resources, index)
+
+        peak_before = kernel_peak_rss(self.km)
+        start = time.perf_counter()
+        try:
+            return super().preprocess_cell(cell, resources, index)
+        finally:
+            wall_time = time.perf_counter() - start
+            peak_after = kernel_peak_rss(self.km)
+            peak_increase = None
+            if peak_before is not None and peak_after is not None:
+                peak_increase = round(peak_after - peak_before, 1)
+            self.cell_timings.append({
+                "cell": index,
+                "first_line": cell["source"].splitlines()[0],
+                "wall_time": round(wall_time, 4),
+                "peak_rss_mb": peak_after,
+                "peak_rss_increase_mb": peak_increase,
+            })
+
+
+def kernel_peak_rss(km):
+    """Return the peak resident memory of the kernel process in MB, if known.
+
+    Reads the high-water mark from /proc, so this is only available on Linux.
+    """
+    try:
+        pid = km.provisioner.process.pid
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def report_profiles(profiles, path, top):
+    """Write per-cell timings to a JSON file and print the slowest cells."""
+    report = {
+        "notebooks": {
+            nb_path: {
+                "wall_time": round(sum(cell["wall_time"] for cell in timings), 4),
+                "cells": timings,
+            }
+            for nb_path, timings in profiles.items()
+        }
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Wrote execution profile to {path}")
+
+    slowest = sorted(
+        (
+            (cell["wall_time"], nb_path, cell)
+            for nb_path, timings in profiles.items()
+            for cell in timings
+        ),
+        key=lambda item: item[0],
+        reverse=True,
+    )[:top]
+    if slowest:
+        print(f"Slowest {len(slowest)} cells:")
+    for wall_time, nb_path, cell in slowest:
+        memory = cell["peak_rss_mb"]
+        memory = "?" if memory is None else f"{memory:.0f}"
+        print(
+            f"{wall_time:9.2f} s {memory:>7} MB  "
+            f"{nb_path} cell {cell['cell']}: {cell['first_line'][:40]}"
+        )
+
+
+def execution_cache_dir(args):
+    """Return the directory holding cached notebook executions."""
+    return os.path.join(args.cache_dir, "executions")
+
+
+@lru_cache(maxsize=None)
+def environment_fingerprint():
+    """Return a hash of the Python version and installed package versions."""
+    packages = sorted(
+        f"{dist.metadata['Name']}=={dist.version}"
+        for dist in metadata.distributions()
+    )
+    fingerprint = "\n".join([sys.version] + packages)
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+def execution_cache_key(nb, kernel_name):
+    """Hash the code cell sources, kernel name and environment of a notebook."""
+    key = hashlib.sha256()
+    key.update(environment_fingerprint().encode("utf-8"))
+    key.update(kernel_name.encode("utf-8"))
+    for cell in nb.get("cells", []):
+        if cell["cell_type"] == "code":
+            key.update(b"\0")
+            key.update(cell["source"].encode("utf-8"))
+    return key.hexdigest()
+
+
+def load_cached_outputs(cache_dir, key, nb):
+    """Replay cached code cell outputs into nb; return True on a cache hit."""
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    code_cells = [cell for cell in nb.get("cells", []) if cell["cell_type"] == "code"]
+    if len(code_cells) != len(cached["cells"]):
+        return False
+
+    for cell, cached_cell in zip(code_cells, cached["cells"]):
+        cell["outputs"] = [nbformat.from_dict(out) for out in cached_cell["outputs"]]
+        cell["execution_count"] = cached_cell["execution_count"]
+    if "language_info" in cached:
+        nb.metadata["language_info"] = nbformat.from_dict(cached["language_info"])
+
+    # Mark the entry as recently used for LRU eviction
+    os.utime(cache_path)
+    return True
+
+
+def store_cached_outputs(cache_dir, key, nb):
+    """Write the code cell outputs of an executed notebook to the cache."""
+    cached = {
+        "cells": [
+            {"outputs": cell["outputs"], "execution_count": cell["execution_count"]}
+            for cell in nb.get("cells", [])
+            if cell["cell_type"] == "code"
+        ],
+    }
+    if "language_info" in nb.metadata:
+        cached["language_info"] = nb.metadata["language_info"]
+
+    write_json(os.path.join(cache_dir, f"{key}.json"), cached)
+
+
+def evict_cache(cache_dir, max_bytes):
+    """Remove least recently used cache entries until under max_bytes."""
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if fname.endswith(".json"):
+            stat = os.stat(os.path.join(cache_dir, fname))
+            entries.append((stat.st_mtime, stat.st_size, fname))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fname in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, fname))
+        total -= size
+
+
+def run_notebook(executor, nb, args):
+    """Execute the notebook on a fresh or warm kernel, returning errors."""
+    if args.warm_kernels:
+        return execute_notebook_warm(executor, nb, args)
+    return execute_notebook(executor, nb, args.raise_fast)
+
+
+def execute_notebook_incremental(executor, nb, args, cache_dir, nb_path, kernel_name):
+    """Re-execute only the code cells affected by edits since the last run.
+
+    Outputs of the other cells are replayed from the last successful run. Falls
+    back to executing the whole notebook when there is no usable record, when
+    a cell has side effects that cannot be analyzed, or when the partial run
+    fails (so that reported errors always come from a full run).
+    """
+    code_cells = [cell for cell in nb.get("cells", []) if cell["cell_type"] == "code"]
+    record = load_cell_record(cache_dir, nb_path, kernel_name)
+    plan = None
+    if record is not None:
+        plan = plan_incremental_execution(
+            [cell["source"] for cell in code_cells],
+            [cell["source"] for cell in record],
+        )
+    if plan is None:
+        return run_notebook(executor, nb, args)
+
+    rerun, replay = plan
+    print(
+        f"Re-executing {len(rerun)} of {len(code_cells)} code cells in {nb_path}",
+        flush=True,
+    )
+    for i, j in replay.items():
+        code_cells[i]["outputs"] = [
+            nbformat.from_dict(out) for out in record[j]["outputs"]
+        ]
+
+    # The partial notebook shares the cells that are re-executed with nb
+    partial_nb = derive_notebook(nb)
+    partial_nb["cells"] = [code_cells[i] for i in rerun]
+    if run_notebook(executor, partial_nb, args) is not None:
+        print(f"Partial execution failed; executing all of {nb_path}", flush=True)
+        return run_notebook(executor, nb, args)
+
+    # Map profiled cells back onto the full notebook
+    nb_index = {id(cell): i for i, cell in enumerate(nb["cells"])}
+    for timing in getattr(executor, "cell_timings", []):
+        timing["cell"] = nb_index[id(partial_nb["cells"][timing["cell"]])]
+    if "language_info" in partial_nb.metadata:
+        nb.metadata["language_info"] = partial_nb.metadata["language_info"]
+
+    # Number the cells as a single execution from a fresh kernel would
+    execution_count = 0
+    for cell in code_cells:
+        if not cell["source"].strip():
+            continue
+        execution_count += 1
+        cell["execution_count"] = execution_count
+        for output in cell["outputs"]:
+            if output["output_type"] == "execute_result":
+                output["execution_count"] = execution_count
+
+
+def plan_incremental_execution(sources, old_sources):
+    """Choose which code cells to re-execute after editing a notebook.
+
+    Returns (rerun, replay), where rerun lists the indices of the cells to
+    execute (edited cells, the cells downstream of them, and the cells those
+    depend on) and replay maps every other cell to its index in old_sources.
+    Returns None if the dependencies between cells cannot be determined.
+    """
+    # Functions and classes defined in the notebook may have any effect
+    functions = set().union(*map(function_names, sources + old_sources))
+
+    # Names imported from the same package may share module state
+    imports = {}
+    for source in sources + old_sources:
+        for name, package in import_packages(source):
+            imports.setdefault(name, set()).add(package)
+
+    names = [cell_names(source, functions, imports) for source in sources]
+    if any(cell is None for cell in names):
+        return None
+
+    # Match unchanged cells between the old and the new notebook
+    matcher = SequenceMatcher(None, old_sources, sources, autojunk=False)
+    matched = {}
+    for block in matcher.get_matching_blocks():
+        for k in range(block.size):
+            matched[block.b + k] = block.a + k
+
+    # Names defined by removed or edited cells are invalidated everywhere
+    dirty = set()
+    for j in set(range(len(old_sources))) - set(matched.values()):
+        old_names = cell_names(old_sources[j], functions, imports)
+        if old_names is None:
+            return None
+        dirty |= old_names[0]
+
+    # Walk forward to find edited cells and the cells downstream of them
+    affected = set()
+    for i, (defined, used) in enumerate(names):
+        if i not in matched or used & dirty:
+            affected.add(i)
+            dirty |= defined
+
+    # Walk backward to add the cells that the affected cells depend on
+    rerun = set(affected)
+    required = set()
+    for i in reversed(range(len(sources))):
+        defined, used = names[i]
+        if i in rerun or defined & required:
+            rerun.add(i)
+            required = (required - defined) | used
+
+    replay = {i: matched[i] for i in range(len(sources)) if i not in rerun}
+    return sorted(rerun), replay
+
+
+def cell_names(source, functions=(), imports=None):
+    """Return the (defined, used) names of a code cell.
+
+    Mutating a name (assigning to an attribute or item, calling it or a method
+    on it, or passing it to a function) counts as both defining and using it.
+    Mutating a name in imports (a dict of the packages each name was imported
+    from) also defines every name imported from the same packages, which may
+    reach the same module state (e.g. `seed` and `np` for numpy). Returns
+    None if the cell has effects that cannot be tracked by name, such as IPython
+    magics, star imports, global statements, calls like exec() and open(), or
+    references to the given functions (those defined in the notebook) outside
+    of function bodies, as calling them may change any global.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+
+    for node in executed_nodes(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id in functions:
+            return None
+
+    defined, used, mutated = set(), set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Global, ast.Nonlocal)):
+            return None
+        elif isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                used.add(node.id)
+            else:
+                defined.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                defined.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.Attribute, ast.Subscript)):
+            if not isinstance(node.ctx, ast.Load):
+                mutated.add(root_name(node))
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in OPAQUE_CALLS:
+                return None
+            if isinstance(node.func, ast.Attribute):
+                mutated.add(root_name(node.func))
+            elif isinstance(node.func, ast.Name) and node.func.id in (imports or ()):
+                mutated.add(node.func.id)
+            for arg in node.args + [kw.value for kw in node.keywords]:
+                mutated.add(root_name(arg))
+
+    if imports:
+        packages = set().union(*(imports.get(name, ()) for name in mutated))
+        mutated |= {name for name, name_packages in imports.items() if name_packages & packages}
+
+    defined |= mutated
+    defined.discard(None)
+    return defined, used | defined
+
+
+def import_packages(source):
+    """Yield (name, top-level package) for each name a code cell imports."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                package = alias.name.split(".")[0]
+                yield alias.asname or package, package
+        elif isinstance(node, ast.ImportFrom):
+            package = "." * node.level + (node.module or "").split(".")[0]
+            for alias in node.names:
+                yield alias.asname or alias.name, package
+
+
+def function_names(source):
+    """Return the global names that a code cell binds to functions, classes or lambdas."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return set()
+
+    names = set()
+    for node in executed_nodes(tree, class_bodies=False):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.NamedExpr)) and node.value is not None:
+            if any(isinstance(child, ast.Lambda) for child in ast.walk(node.value)):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                names.update(
+                    child.id for target in targets for child in ast.walk(target)
+                    if isinstance(child, ast.Name)
+                )
+    return names
+
+
+def executed_nodes(tree, class_bodies=True):
+    """Walk the nodes of a cell that run when it runs, skipping function bodies."""
+    todo = deque([tree])
+    while todo:
+        node = todo.popleft()
+        yield node
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            todo.extend(node.decorator_list)
+            todo.append(node.args)
+            if node.returns is not None:
+                todo.append(node.returns)
+        elif isinstance(node, ast.ClassDef) and not class_bodies:
+            todo.extend(node.decorator_list + node.bases + node.keywords)
+        else:
+            todo.extend(ast.iter_child_nodes(node))
+
+
+def root_name(node):
+    """Return the name at the root of an attribute/item/call chain, if any."""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call, ast.Starred)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def test_plan_incremental_execution():
+
+    old = [
+        "import numpy as np",
+        "x = np.arange(3)",
+        "y = 2",
+        "print(x)",
+        "print(y)",
+    ]
+
+    # Editing a cell re-runs it, its dependencies and its dependents
+    new = old[:2] + ["y = 3"] + old[3:]
+    rerun, replay = plan_incremental_execution(new, old)
+    assert rerun == [2, 4]
+    assert replay == {0: 0, 1: 1, 3: 3}
+
+    # Calling a method on a name may mutate it
+    new = old[:2] + ["x.sort()"] + old[3:]
+    rerun, replay = plan_incremental_execution(new, old)
+    assert rerun == [0, 1, 2, 3, 4]
+
+    # Unchanged notebooks do not need to run at all
+    assert plan_incremental_execution(old, old) == ([], {i: i for i in range(5)})
+
+    # Magics make dependencies unknowable
+    assert plan_incremental_execution(old + ["%matplotlib inline"], old) is None
+
+    # So do calls to notebook functions, which may mutate globals they close over
+    old = ["d = {}", "def add(k):\n    d[k] = 1", "add(1)", "print(d)"]
+    new = old[:2] + ["add(2)"] + old[3:]
+    assert plan_incremental_execution(new, old) is None
+    new = old[:2] + ["callback = add"] + old[3:]
+    assert plan_incremental_execution(new, old) is None
+    new = old[:2] + ["f = lambda k: d.update({k: 2})", "f(1)"] + old[3:]
+    assert plan_incremental_execution(new, old[:2] + old[3:]) is None
+
+    # State changed through one imported name is seen through the others
+    old = ["import numpy as np", "from numpy.random import seed", "seed(1)",
+           "x = np.random.rand()", "print(x)"]
+    new = old[:2] + ["seed(2)"] + old[3:]
+    assert plan_incremental_execution(new, old) == ([0, 1, 2, 3, 4], {})
+    old = ["import matplotlib as mpl", "import matplotlib.pyplot as plt",
+           "mpl.rcParams['lines.linewidth'] = 4", "plt.plot([1, 2])"]
+    new = old[:2] + ["mpl.rcParams['lines.linewidth'] = 5"] + old[3:]
+    assert plan_incremental_execution(new, old)[1] == {}
+    old = ["import random", "from random import random as r", "random.seed(1)", "print(r())"]
+    new = old[:2] + ["random.seed(2)"] + old[3:]
+    assert plan_incremental_execution(new, old)[1] == {}
+
+    # Defining a function without calling it is fine, recursion included
+    old = ["d = {}", "def f(n):\n    return f(n - 1) if n else 0", "print(d)"]
+    new = ["d = {1: 1}"] + old[1:]
+    assert plan_incremental_execution(new, old) == ([0, 2], {1: 1})
+
+
+def cell_record_path(cache_dir, nb_path):
+    """Return the path of the last-run record for a notebook."""
+    path_hash = hashlib.sha256(os.path.normpath(nb_path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"cells-{path_hash}.json")
+
+
+def load_cell_record(cache_dir, nb_path, kernel_name):
+    """Load the code cells from the last successful run of a notebook, if usable."""
+    try:
+        with open(cell_record_path(cache_dir, nb_path)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if record["environment"] != execution_cache_key({}, kernel_name):
+        return None
+    return record["cells"]
+
+
+def store_cell_record(cache_dir, nb_path, kernel_name, nb):
+    """Record the code cells of a successful run for incremental execution."""
+    record = {
+        "environment": execution_cache_key({}, kernel_name),
+        "cells": [
+            {"source": cell["source"], "outputs": cell["outputs"]}
+            for cell in nb.get("cells", [])
+            if cell["cell_type"] == "code"
+        ],
+    }
+    write_json(cell_record_path(cache_dir, nb_path), record)
+
+
+def execute_notebook_warm(executor, nb, args):
+    """Execute the notebook on a reused kernel, returning errors to be handled.
+
+    The kernel namespace, working directory, sys.path, environment, random
+    seeds and matplotlib settings are reset after every notebook (other module
+    state is kept, as with the imports themselves). Kernels are discarded
+    after a failure, and a notebook whose execution counts do not start from 1
+    is re-executed on a fresh kernel.
+    """
+    kernel_name = notebook_kernel_name(nb, executor.kernel_name)
+    km = get_warm_kernel(kernel_name, args.warm_imports)
+    try:
+        error = execute_notebook(executor, nb, args.raise_fast, km=km)
+    finally:
+        if executor.kc is not None:
+            executor.kc.stop_channels()
+        if not km.is_alive():
+            discard_warm_kernel(kernel_name)
+
+    if error is not None:
+        discard_warm_kernel(kernel_name)
+        return error
+
+    if not sequentially_executed(nb):
+        discard_warm_kernel(kernel_name)
+        return execute_notebook(executor, nb, args.raise_fast)
+
+    # Reset now, so that the kernel is clean when the next notebook needs it
+    try:
+        run_in_kernel(km, RESET_KERNEL_CODE)
+    except RuntimeError:
+        discard_warm_kernel(kernel_name)
+
+
+def get_warm_kernel(kernel_name, imports):
+    """Return a running kernel with the given modules imported and a clean namespace."""
+    km = WARM_KERNELS.get(kernel_name)
+    if km is not None:
+        return km
+
+    km = KernelManager(kernel_name=kernel_name)
+    km.start_kernel()
+    Finalize(None, km.shutdown_kernel, kwargs={"now": True}, exitpriority=0)
+    run_in_kernel(km, WARM_KERNEL_CODE.format(imports=imports.split(",")))
+    WARM_KERNELS[kernel_name] = km
+    return km
+
+
+def discard_warm_kernel(kernel_name):
+    """Shut down a warm kernel so that the next notebook starts a fresh one."""
+    km = WARM_KERNELS.pop(kernel_name, None)
+    if km is not None and km.has_kernel:
+        km.shutdown_kernel(now=True)
+
+
+def run_in_kernel(km, code, timeout=120):
+    """Run code silently in the kernel, raising RuntimeError if it fails."""
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=timeout)
+        reply = kc.execute_interactive(
+            code,
+            silent=True,
+            store_history=False,
+            timeout=timeout,
+            output_hook=lambda msg: None,
+        )
+    finally:
+        kc.stop_channels()
+    content = reply["content"]
+    if content["status"] != "ok":
+        raise RuntimeError(f"{content.get('ename')}: {content.get('evalue')}")
 
 
 def check_execution(executor, nb, raise_fast):
@@ -227,7 +1087,7 @@ def check_execution(executor, nb, raise_fast):
             continue
 
         if cell["source"] and cell["execution_count"] is None:
-            error = "Notebook has unexecuted code cell(s)."
+            error = UNEXECUTED_ERROR
             if raise_fast:
                 raise RuntimeError(error)
             break
@@ -244,9 +1104,53 @@ def check_execution(executor, nb, raise_fast):
     return error
 
 
+def fast_check(nb_path, require_sequential, allow_error_names):
+    """Check execution order, missing executions and errors in a single pass.
+
+    The notebook JSON is decoded without nbformat validation or conversion
+    to NotebookNode objects. The checks and messages match those of
+    sequentially_executed and check_execution.
+    """
+    with open(nb_path, "rb") as f:
+        cells = json.load(f).get("cells", [])
+
+    sequential = True
+    expected_count = 1
+    checking = True
+    error = None
+    for cell in cells:
+
+        source = cell["source"]
+        if isinstance(source, list):
+            source = "".join(source)
+        execution_count = cell.get("execution_count")
+        if source and execution_count is not None:
+            sequential &= execution_count == expected_count
+            expected_count += 1
+
+        # Only check code cells
+        if cell["cell_type"] != "code" or not checking:
+            continue
+
+        if source and execution_count is None:
+            error = UNEXECUTED_ERROR
+            checking = False
+        else:
+            for output in cell["outputs"]:
+                if output["output_type"] == "error":
+                    if output["ename"] in allow_error_names:
+                        continue
+                    error = "\n".join(output["traceback"])
+                    break
+
+    if require_sequential and not sequential:
+        return SEQUENTIAL_ERROR
+    return error
+
+
 def extract_solutions(nb, nb_dir, nb_name):
     """Convert solution cells to markdown; embed images from Python output."""
-    nb = deepcopy(nb)
+    nb = derive_notebook(nb)
     _, unit_dir = os.path.split(nb_dir)
 
     static_images = {}
@@ -257,6 +1161,9 @@ def extract_solutions(nb, nb_dir, nb_name):
 
         if has_solution(cell):
 
+            # Only the solution cell is modified, so only it is copied
+            cell = nb_cells[i] = copy_cell(cell)
+
             # Get the cell source
             cell_source = cell["source"]
 
@@ -272,7 +1179,7 @@ def extract_solutions(nb, nb_dir, nb_name):
                     image_data = a2b_base64(output["data"]["image/png"])
                 except KeyError:
                     continue
-                cell_images[fname] = Image.open(BytesIO(image_data))
+                cell_images[fname] = image_data
             static_images.update(cell_images)
 
             # Clean up the cell source and assign a filename
@@ -288,14 +1195,14 @@ def extract_solutions(nb, nb_dir, nb_name):
 
             if cell_images:
                 new_source += "*Example output:*\n\n"
-                for f, img in cell_images.items():
+                for f, image_data in cell_images.items():
 
                     url = f"{GITHUB_RAW_URL}/units/{unit_dir}/{f}"
 
                     # Handle matplotlib retina mode
-                    dpi_w, dpi_h = img.info["dpi"]
-                    w = img.width // (dpi_w // 72)
-                    h = img.height // (dpi_h // 72)
+                    width, height, (dpi_w, dpi_h) = png_geometry(image_data)
+                    w = width // (dpi_w // 72)
+                    h = height // (dpi_h // 72)
 
                     tag_args = " ".join([
                         "alt='Solution hint'",
@@ -319,9 +1226,60 @@ def extract_solutions(nb, nb_dir, nb_name):
     return nb, static_images, solution_snippets
 
 
+def png_geometry(data):
+    """Read the pixel size and DPI of a PNG from its header chunks.
+
+    The DPI matches what PIL reports for the pHYs chunk; images without one
+    are treated as 72 DPI. Pixel data is never decoded.
+    """
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Not a PNG image")
+
+    width = height = None
+    dpi = 72, 72
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack(">II", chunk[:8])
+        elif chunk_type == b"pHYs" and chunk[8] == 1:  # pixels per meter
+            px, py = struct.unpack(">II", chunk[:8])
+            dpi = px * 0.0254, py * 0.0254
+        elif chunk_type in (b"IDAT", b"IEND"):
+            break
+        pos += 12 + length
+
+    if width is None:
+        raise ValueError("PNG image has no IHDR chunk")
+    return width, height, dpi
+
+
+def test_png_geometry():
+
+    import zlib
+
+    def chunk(chunk_type, body):
+        crc = zlib.crc32(chunk_type + body)
+        return struct.pack(">I", len(body)) + chunk_type + body + struct.pack(">I", crc)
+
+    ihdr = chunk(b"IHDR", struct.pack(">IIBBBBB", 640, 480, 8, 6, 0, 0, 0))
+    phys = chunk(b"pHYs", struct.pack(">IIB", 5669, 5669, 1))
+    idat = chunk(b"IDAT", zlib.compress(b""))
+    iend = chunk(b"IEND", b"")
+    signature = b"\x89PNG\r\n\x1a\n"
+
+    width, height, dpi = png_geometry(signature + ihdr + phys + idat + iend)
+    assert (width, height) == (640, 480)
+    assert dpi == (5669 * 0.0254, 5669 * 0.0254)
+
+    width, height, dpi = png_geometry(signature + ihdr + idat + iend)
+    assert (width, height, dpi) == (640, 480, (72, 72))
+
+
 def instructor_version(nb, nb_dir, nb_name):
     """Convert notebook to instructor notebook."""
-    nb = deepcopy(nb)
+    nb = derive_notebook(nb)
     _, unit_dir = os.path.split(nb_dir)
 
     nb_cells = nb.get("cells", [])
@@ -332,6 +1290,7 @@ def instructor_version(nb, nb_dir, nb_name):
                 cell_id = i-2
             else:
                 cell_id = i-1
+            nb_cells[cell_id] = copy_cell(nb_cells[cell_id])
             nb_cells[cell_id]["cell_type"] = "markdown"
             nb_cells[cell_id]["metadata"]["colab_type"] = "text"
             if "outputID" in nb_cells[cell_id]["metadata"]:
@@ -348,8 +1307,8 @@ def instructor_version(nb, nb_dir, nb_name):
 
 def clean_notebook(nb, clear_outputs=True):
     """Remove cell outputs and most unimportant metadata."""
-    # Always operate on a copy of the input notebook
-    nb = deepcopy(nb)
+    # Never modify the cells of the input notebook
+    nb = derive_notebook(nb)
 
     # Remove some noisy metadata
     nb.metadata.pop("widgets", None)
@@ -360,12 +1319,14 @@ def clean_notebook(nb, clear_outputs=True):
     }
 
     # Iterate through the cells and clean up each one
+    cells = []
     for cell in nb.get("cells", []):
 
         # Remove blank cells
         if not cell["source"]:
-            nb.cells.remove(cell)
             continue
+        cell = copy_cell(cell)
+        cells.append(cell)
 
         # Reset cell-level Jupyter metadata
         for key in ["prompt_number", "execution_count"]:
@@ -392,9 +1353,31 @@ def clean_notebook(nb, clear_outputs=True):
             if "@title" in first_line or "@markdown" in first_line:
                 cell["metadata"]["cellView"] = "form"
 
+    nb["cells"] = cells
     return nb
 
 
+def derive_notebook(nb):
+    """Return a copy of nb that shares its (unmodified) cells with the original.
+
+    Cells of the derived notebook must be replaced using copy_cell before they
+    are modified, so that outputs are never copied unless they change.
+    """
+    derived = copy(nb)
+    derived["metadata"] = deepcopy(nb["metadata"])
+    if "cells" in nb:
+        derived["cells"] = list(nb["cells"])
+    return derived
+
+
+def copy_cell(cell):
+    """Return a copy of cell with its own metadata, sharing its outputs."""
+    cell = copy(cell)
+    if "metadata" in cell:
+        cell["metadata"] = deepcopy(cell["metadata"])
+    return cell
+
+
 def add_colab_metadata(nb, nb_name):
     """Ensure that notebook has Colab metadata and enforce some settings."""
     if "colab" not in nb["metadata"]:
@@ -577,12 +1560,69 @@ def sequentially_executed(nb):
     return exec_counts == sequential_counts
 
 
-def make_sub_dir(nb_dir, name):
-    """Create nb_dir/name if it does not exist."""
-    sub_dir = os.path.join(nb_dir, name)
-    if not os.path.exists(sub_dir):
-        os.mkdir(sub_dir)
-    return sub_dir
+def notebook_bytes(nb):
+    """Serialize a notebook exactly as nbformat.write would."""
+    text = nbformat.writes(nb)
+    if not text.endswith("\n"):
+        text += "\n"
+    return text.encode("utf-8")
+
+
+def notebook_hash(nb):
+    """Hash a notebook together with the settings and code that affect its derivatives."""
+    key = hashlib.sha256()
+    key.update(f"{REPO}\0{MAIN_BRANCH}\0{script_hash()}\0".encode("utf-8"))
+    key.update(nbformat.writes(nb).encode("utf-8"))
+    return key.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def script_hash():
+    """Hash the source of this script, so that changes to it invalidate the manifest."""
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_if_changed(path, data):
+    """Write bytes to path unless the file already has identical contents."""
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return True
+
+
+def load_manifest(nb_dir):
+    """Load the record of derived artifacts for notebooks in nb_dir."""
+    try:
+        with open(os.path.join(nb_dir, MANIFEST_FNAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(nb_dir, manifest, write):
+    """Write the record of derived artifacts for notebooks in nb_dir."""
+    data = json.dumps(manifest, indent=1, sort_keys=True) + "\n"
+    write(os.path.join(nb_dir, MANIFEST_FNAME), data.encode("utf-8"))
+
+
+def artifacts_up_to_date(nb_dir, entry, source_hash):
+    """Return True if a manifest entry matches the source and the files on disk."""
+    if entry is None or entry["source"] != source_hash:
+        return False
+    for rel_path, artifact_hash in entry["artifacts"].items():
+        try:
+            with open(os.path.join(nb_dir, rel_path), "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != artifact_hash:
+                    return False
+        except FileNotFoundError:
+            return False
+    return True
 
 
 def exit(errors):
@@ -630,12 +1670,93 @@ def parse_args(arglist):
         dest="check_only",
         help="Only run QC checks; don't do post-processing."
     )
+    parser.add_argument(
+        "--fast-check",
+        action="store_true",
+        dest="fast_check",
+        help=(
+            "Only check execution order, unexecuted cells and error outputs "
+            "in one pass over the raw notebook JSON, then exit."
+        )
+    )
     parser.add_argument(
         "--raise-fast",
         action="store_true",
         dest="raise_fast",
         help="Raise errors immediately rather than collecting and reporting."
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of notebooks to check/execute in parallel (ignored with --raise-fast)."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        dest="use_cache",
+        help="Always execute notebooks rather than reusing cached outputs."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=CACHE_DIR,
+        dest="cache_dir",
+        help="Directory for the execution cache (default: $C4R_CACHE_DIR or ~/.cache/c4rci)."
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        dest="cache_size",
+        help="Maximum size of the execution cache in MB."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only re-execute code cells affected by edits since the last cached "
+            "run, replaying the outputs of the other cells."
+        )
+    )
+    parser.add_argument(
+        "--warm-kernels",
+        action="store_true",
+        dest="warm_kernels",
+        help=(
+            "Reuse one kernel per worker across notebooks, resetting its namespace "
+            "between notebooks instead of starting a new kernel each time."
+        )
+    )
+    parser.add_argument(
+        "--warm-imports",
+        default="numpy,matplotlib.pyplot",
+        dest="warm_imports",
+        help="Comma-separated modules to import when starting a warm kernel."
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="PATH",
+        help="Write per-cell execution time and kernel memory to a JSON report."
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=10,
+        dest="profile_top",
+        help="Number of slowest cells to summarize with --profile."
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=None,
+        dest="memory_budget",
+        help=(
+            "Stream notebooks through execution and post-processing, keeping about "
+            "this many MB of executed notebooks (measured as serialized JSON) in "
+            "memory. Outputs are staged and only written if every notebook passes."
+        )
+    )
     return parser.parse_args(arglist)
 
 
@@ -0,0 +1,175 @@
+"""Persistent caches of results keyed by content hash, shared by the CI scripts.
+
+A cache is a dict of named sections, each mapping keys to JSON results in
+order from least to most recently used. It is saved as a single JSON file
+along with a version, and files with another version are discarded.
+
+`map_cached` spreads work over a process pool. Each worker receives the cache
+once when it starts and sends back, with each result, the keys it used and
+the entries it added, so that the cache and its recency order stay the same
+as if the work had been done in the main process.
+
+"""
+import os
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+CACHE_DIR = os.environ.get(
+    "C4R_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "c4rci")
+)
+
+# The copy of the cache held by a pool worker, set by init_worker, and the
+# keys of each section that the main process has or will have by the time
+# the results of the worker's current job are merged
+_worker_cache = None
+_worker_known = None
+
+# Marks where a job's entries start in the recency order of a worker's cache
+_JOB_START = object()
+
+
+def load_cache(path, version, sections):
+    """Load the named sections of a cache file, empty if missing or outdated."""
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict) or cache.get("version") != version:
+        cache = {}
+    return {name: cache.get(name, {}) for name in sections}
+
+
+def save_cache(path, cache, version, size):
+    """Atomically write a cache, keeping the `size` most recently used entries of each section."""
+    data = {
+        name: dict(list(entries.items())[-size:])
+        for name, entries in cache.items()
+    }
+    data["version"] = version
+    write_json(path, data)
+
+
+def write_json(path, data, **kwargs):
+    """Write JSON to a temporary file and move it into place, so that
+    concurrent readers never see a partially written file."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def lookup(section, key, compute):
+    """Return the cached result for key, computing and adding it if missing."""
+    if key in section:
+        section[key] = section.pop(key)  # Mark as recently used
+    else:
+        section[key] = compute()
+    return section[key]
+
+
+def map_cached(func, items, cache=None, jobs=None):
+    """Return [func(item, cache) for item in items], run in up to `jobs` processes.
+
+    func must be a module-level function, and cache (if any) is updated as
+    if every call had been made in this process.
+
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item, cache) for item in items]
+
+    with ProcessPoolExecutor(
+        min(jobs, len(items)), initializer=init_worker, initargs=(cache,)
+    ) as pool:
+        outputs = list(pool.map(partial(run_job, func), items))
+
+    results = []
+    for result, updates in outputs:
+        results.append(result)
+        if cache is not None:
+            merge_updates(cache, updates)
+    return results
+
+
+def init_worker(cache):
+    global _worker_cache, _worker_known
+    _worker_cache = cache
+    if cache is not None:
+        _worker_known = {name: set(section) for name, section in cache.items()}
+
+
+def run_job(func, item):
+    """Call func in a worker, returning the result and the cache updates.
+
+    Lookups move the keys they use to the end of a section, so the keys after
+    a marker added before the call are those used by it, in order. Only the
+    entries unknown to the main process are sent with their values.
+
+    """
+    cache = _worker_cache
+    if cache is None:
+        return func(item, None), {}
+
+    for section in cache.values():
+        section[_JOB_START] = None
+    try:
+        result = func(item, cache)
+    finally:
+        updates = {}
+        for name, section in cache.items():
+            used = []
+            for key in reversed(section):
+                if key is _JOB_START:
+                    break
+                used.append(key)
+            del section[_JOB_START]
+            used.reverse()
+            known = _worker_known[name]
+            updates[name] = used, {key: section[key] for key in used if key not in known}
+            known.update(used)
+    return result, updates
+
+
+def merge_updates(cache, updates):
+    """Apply the keys used and entries added by a worker job to the cache."""
+    for name, (used, entries) in updates.items():
+        section = cache[name]
+        for key in used:
+            if key in entries:
+                section.pop(key, None)
+                section[key] = entries[key]
+            else:
+                section[key] = section.pop(key)
+
+
+def test_map_cached():
+
+    cache = {"squares": {"1": 1, "2": 4, "3": 9}}
+    items = [[2, 4], [4, 5], [2]]
+    expected = [[4, 16], [16, 25], [4]]
+
+    # A pool gives the same results, entries and recency order as a loop
+    serial = {name: dict(section) for name, section in cache.items()}
+    assert map_cached(squares_job, items, serial, jobs=1) == expected
+    assert map_cached(squares_job, items, cache, jobs=2) == expected
+    assert list(cache["squares"]) == ["1", "3", "4", "5", "2"]
+    assert list(cache["squares"]) == list(serial["squares"])
+    assert cache == serial
+
+    assert map_cached(squares_job, items, None, jobs=2) == expected
+
+
+def squares_job(numbers, cache):
+    if cache is None:
+        return [n * n for n in numbers]
+    return [lookup(cache["squares"], str(n), lambda: n * n) for n in numbers]
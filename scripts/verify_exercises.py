@@ -15,12 +15,23 @@ This script will report whether exercises and solutions otherwise match.
 
 """
 import os
+import io
 import re
 import sys
+import json
+import hashlib
 import argparse
-from textwrap import dedent
+import tokenize
+import collections
 from fuzzywuzzy import fuzz
 import nbformat
+from result_cache import CACHE_DIR, load_cache, save_cache, lookup, map_cached
+
+# Maximum number of parsed cells to keep between runs
+LOGICAL_LINES_CACHE_SIZE = 20000
+
+# Bump when logical_lines changes, so that cached parses are discarded
+LOGICAL_LINES_VERSION = 1
 
 
 def main(arglist):
@@ -33,56 +44,36 @@ def main(arglist):
         print("Skipping exercise verification")
         sys.exit(0)
 
-    # Track overall status
-    failure = False
-    unmatched = {}
+    # Reuse the parsed code and comments of cells seen on previous runs
+    cache = load_logical_lines_cache(args.cache) if args.use_cache else None
 
-    for nb_fpath in args.files:
+    # Verify the notebooks, spreading them across processes
+    results = map_cached(verify_notebook, args.files, cache, args.jobs)
 
+    if cache is not None:
+        save_logical_lines_cache(args.cache, cache)
+
+    unmatched = {}
+    for nb_fpath, exercises in zip(args.files, results):
         _, nb_name = os.path.split(nb_fpath)
-        unmatched[nb_name] = []
-
-        # Load the notebook file
-        with open(nb_fpath) as f:
-            nb = nbformat.read(f, nbformat.NO_CONVERT)
-
-        for i, cell in enumerate(nb.get("cells", [])):
-
-            # Detect solution cells based on removal tag
-            if has_solution(cell):
-
-                # Find a corresponding exercise cell
-                # (Assume it is the previous *code* cell)
-                j, stub_cell = 1, None
-                while (i - j):
-                    stub_cell = nb["cells"][i - j]
-                    if stub_cell["cell_type"] == "code":
-                        break
-                    else:
-                        stub_cell = None
-                    j += 1
-                if stub_cell is None:
-                    continue
-
-                # Extract the code and comments from both cells
-                stub_code, stub_comments = logical_lines(stub_cell["source"])
-                solu_code, solu_comments = logical_lines(cell["source"])
-
-                # Identify violations in the exercise cell
-                unmatched_code = unmatched_lines(stub_code, solu_code)
-                unmatched_comments = unmatched_lines(
-                    stub_comments, solu_code + solu_comments
-                )
-                unmatched[nb_name].append((unmatched_code, unmatched_comments))
-                if unmatched_code or unmatched_comments:
-                    failure = True
+        unmatched[nb_name] = exercises
+
+    # Track overall status
+    failure = any(
+        not exercise["passed"]
+        for exercises in unmatched.values() for exercise in exercises
+    )
 
     # Report the results for this noteobokk
     for nb_name, nb_unmatched in unmatched.items():
         print()
         print("---" + nb_name + "-" * (69 - 5 - len(nb_name)))
-        for exercise, (code, comments) in enumerate(nb_unmatched, 1):
-            report(exercise, code, comments)
+        for exercise in nb_unmatched:
+            report(exercise)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"success": not failure, "notebooks": unmatched}, f, indent=4)
 
     # Print overall summary and exit with return code
     message = "Failure" if failure else "Success"
@@ -90,23 +81,84 @@ def main(arglist):
     sys.exit(failure)
 
 
-def report(exercise, code, comment, thresh=50):
+def verify_notebook(nb_fpath, cache=None):
+    """Compare each exercise in a notebook to its solution.
+
+    Returns a record for each exercise with its number, whether it passed, and
+    the unmatched code and comment lines (each with its score, the stub line
+    and the closest solution line). If a `cache` (see
+    `load_logical_lines_cache`) is given, cells are parsed with
+    `cached_logical_lines`.
+
+    """
+    # Load the notebook file
+    with open(nb_fpath) as f:
+        nb = nbformat.read(f, nbformat.NO_CONVERT)
+
+    exercises = []
+
+    for stub_cell, cell in exercise_cells(nb):
+
+        # Extract the code and comments from both cells
+        if cache is None:
+            stub_code, stub_comments = logical_lines(stub_cell["source"])
+            solu_code, solu_comments = logical_lines(cell["source"])
+        else:
+            stub_code, stub_comments = cached_logical_lines(stub_cell["source"], cache["cells"])
+            solu_code, solu_comments = cached_logical_lines(cell["source"], cache["cells"])
+
+        # Identify violations in the exercise cell
+        unmatched_code = unmatched_lines(stub_code, solu_code)
+        unmatched_comments = unmatched_lines(
+            stub_comments, solu_code + solu_comments
+        )
+        exercises.append({
+            "exercise": len(exercises) + 1,
+            "passed": not (unmatched_code or unmatched_comments),
+            "code": [unmatched_record(*line) for line in unmatched_code],
+            "comments": [unmatched_record(*line) for line in unmatched_comments],
+        })
+
+    return exercises
+
+
+def exercise_cells(nb):
+    """Yield (exercise, solution) cell pairs from a notebook.
+
+    Solution cells are detected based on their removal tag, and the exercise
+    is assumed to be the previous *code* cell (not counting the first cell).
+
+    """
+    stub_cell = None
+    for i, cell in enumerate(nb.get("cells", [])):
+        if has_solution(cell) and stub_cell is not None:
+            yield stub_cell, cell
+        if i and cell["cell_type"] == "code":
+            stub_cell = cell
+
+
+def unmatched_record(score, stub, solu):
+    return {"score": score, "stub": stub, "solution": solu}
+
+
+def report(exercise, thresh=50):
     """Print information about unmatched code and comments in an exercise."""
+    code, comment = exercise["code"], exercise["comments"]
     code_status = "FAIL" if code else "PASS"
     comment_status = "FAIL" if comment else "PASS"
     print(
-        f"Exercise {exercise} | Code {code_status} | Comments {comment_status}"
+        f"Exercise {exercise['exercise']} | Code {code_status} | Comments {comment_status}"
     )
 
     for kind, unmatched in zip(["Code", "Comment"], [code, comment]):
-        for (score, stub, solu) in unmatched:
-            if score < thresh:
+        for line in unmatched:
+            if line["score"] < thresh:
                 print(f"  {kind} without close match:")
-                print(f"  * {stub}")
+                print(f"  * {line['stub']}")
             else:
-                print(f"  {kind} with close mismatch ({score}%)")
-                print(f"  + {stub}")
-                print(f"  - {solu}")
+                print(f"  {kind} with close mismatch ({line['score']}%)")
+                print(f"  + {line['stub']}")
+                print(f"  - {line['solution']}")
 
 
 def logical_lines(func_str):
@@ -123,12 +175,16 @@ def logical_lines(func_str):
     making_xkcd_plot = False
     reading_block_comment = False
 
-    for line in func_str.split("\n"):
+    # Find where comments start, so that a # inside a string is not mistaken
+    # for one (falling back to the first hash if the cell does not tokenize)
+    columns = comment_columns(func_str)
+
+    for row, line in enumerate(func_str.split("\n"), 1):
 
         # Detect and ignore lines within multi-line comments
         # - triple quotes (docstrings)
         # - comment hashmark fences
-        comment_block_fence = dedent(line).startswith('"""') or "###" in line
+        comment_block_fence = line.lstrip(" \t").startswith('"""') or "###" in line
         if reading_block_comment:
             if comment_block_fence:
                 reading_block_comment = False
@@ -150,17 +206,21 @@ def logical_lines(func_str):
                 reading_block_comment = True
                 continue
 
-        match = pattern.match(line)
+        if columns is None:
+            column = line.find("#") if "#" in line else len(line)
+        else:
+            column = columns.get(row, len(line))
+        match = pattern.match(line[column:])
         if match:
 
-            # Split the line on the first comment hash encountered
-            code_line = match.group(1)
+            # Split the line where the comment starts
+            code_line = line[:column]
             comment_line = match.group(2)
 
             # If there is code before the comment, assume comment is inline
             # use entire line (allows inline comments in commented-out code)
-            if dedent(code_line):
-                code_line = match.group(0)
+            if code_line.lstrip(" \t"):
+                code_line = line
 
             # Handle xkcd context, which is always last thing in solution cell
             if "plt.xkcd()" in code_line:
@@ -174,38 +234,104 @@ def logical_lines(func_str):
             if not skip_code(code_line):
                 code_lines.append(code_line)
 
-            if not dedent(code_line) and not skip_comment(comment_line):
+            if not code_line.lstrip(" \t") and not skip_comment(comment_line):
                 comment_lines.append(comment_line)
 
     return code_lines, comment_lines
 
 
+def comment_columns(source):
+    """Map line numbers to the column where a comment starts on that line.
+
+    Returns None if the source cannot be tokenized.
+
+    """
+    columns = {}
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(source).readline):
+            if token.type == tokenize.COMMENT:
+                row, col = token.start
+                columns[row] = col
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return columns
+
+
+def cached_logical_lines(func_str, cache):
+    """Extract code and comments like logical_lines, memoized by source hash."""
+    key = hashlib.sha256(func_str.encode("utf-8")).hexdigest()
+    code_lines, comment_lines = lookup(cache, key, lambda: logical_lines(func_str))
+    return list(code_lines), list(comment_lines)
+
+
+def load_logical_lines_cache(path):
+    """Load the parsed cells cached by previous runs."""
+    return load_cache(path, LOGICAL_LINES_VERSION, ("cells",))
+
+
+def save_logical_lines_cache(path, cache):
+    """Atomically write the cache, keeping the most recently used entries."""
+    save_cache(path, cache, LOGICAL_LINES_VERSION, LOGICAL_LINES_CACHE_SIZE)
+
+
 def unmatched_lines(stub_lines, solu_lines):
-    """Identify lines in the exercise stub without a match in the solution."""
+    """Identify lines in the exercise stub without a match in the solution.
+
+    This gives the same scores as comparing every stub line with every solution
+    line, but exact matches are found with a set lookup and solution lines
+    are scored in order of an upper bound on their score, stopping once no
+    remaining line can beat the best match so far.
+
+    """
     unmatched = []
 
+    exact_lines = set(solu_lines)
+    solu_chars = [collections.Counter(line) for line in solu_lines]
+
     for stub_line in stub_lines:
 
+        # Match whole lines or parts of lines that need completion
+        if "..." in stub_line:
+            parts = [part for part in stub_line.split("...") if part]
+            part_chars = [collections.Counter(part) for part in parts]
+
+            def score(line):
+                return min(fuzz.partial_ratio(part, line) for part in parts)
+
+            bounds = [
+                min(
+                    partial_ratio_bound(part, chars, line, line_chars)
+                    for part, chars in zip(parts, part_chars)
+                )
+                for line, line_chars in zip(solu_lines, solu_chars)
+            ]
+        else:
+            if stub_line in exact_lines:
+                continue
+
+            def score(line):
+                return fuzz.ratio(stub_line, line)
+
+            stub_chars = collections.Counter(stub_line)
+            bounds = [
+                ratio_bound(stub_line, stub_chars, line, line_chars)
+                for line, line_chars in zip(solu_lines, solu_chars)
+            ]
+
         # When we don't match, we want to track lines that are close
+        # (the first of the best scoring lines, as long as it scores above 0)
         best_score = 0
-        best_line = ""
-
-        for line in solu_lines:
-
-            # Match whole lines or parts of lines that need completion
-            if "..." in stub_line:
-                part_scores = []
-                for part in stub_line.split("..."):
-                    if not part:
-                        continue
-                    part_scores.append(fuzz.partial_ratio(part, line))
-                score = min(part_scores)
-            else:
-                score = fuzz.ratio(stub_line, line)
-
-            if score > best_score:
-                best_score = score
-                best_line = line
+        best_index = None
+        for i in sorted(range(len(solu_lines)), key=lambda i: (-bounds[i], i)):
+            if bounds[i] < best_score:
+                break
+            if bounds[i] == best_score and (best_index is None or i > best_index):
+                continue
+            line_score = score(solu_lines[i])
+            if line_score > best_score or (line_score == best_score > 0 and i < best_index):
+                best_score = line_score
+                best_index = i
+        best_line = "" if best_index is None else solu_lines[best_index]
 
         # Track all lines that are not perfect matches
         if best_score < 100:
@@ -214,15 +340,93 @@ def unmatched_lines(stub_lines, solu_lines):
     return unmatched
 
 
+def ratio_bound(a, a_chars, b, b_chars):
+    """Upper bound on fuzz.ratio(a, b) from the characters the strings share.
+
+    The ratio counts characters in matching blocks, which can be no more than
+    the characters the two strings have in common.
+
+    """
+    if a == b:
+        return 100
+    if not a or not b:
+        return 0
+    common = sum((a_chars & b_chars).values())
+    return score_bound(2 * common / (len(a) + len(b)))
+
+
+def partial_ratio_bound(a, a_chars, b, b_chars):
+    """Upper bound on fuzz.partial_ratio(a, b) from the characters they share.
+
+    partial_ratio scores the shorter string against substrings of the longer
+    one that are at most as long, which can share no more characters with it
+    than the whole longer string does.
+
+    """
+    if a == b:
+        return 100
+    if not a or not b:
+        return 0
+    common = sum((a_chars & b_chars).values())
+    return score_bound(2 * common / (min(len(a), len(b)) + common))
+
+
+def score_bound(ratio):
+    """Round a bound on a similarity ratio up to a bound on its integer score."""
+    # partial_ratio reports any ratio above .995 as a perfect match, and the
+    # slack covers floating point differences in how the ratio is computed
+    if ratio > .995 - 1e-9:
+        return 100
+    return int(round(100 * ratio + 1e-6))
+
+
+def test_unmatched_lines():
+
+    import random
+
+    def reference(stub_lines, solu_lines):
+        unmatched = []
+        for stub_line in stub_lines:
+            best_score = 0
+            best_line = ""
+            for line in solu_lines:
+                if "..." in stub_line:
+                    score = min(
+                        fuzz.partial_ratio(part, line)
+                        for part in stub_line.split("...") if part
+                    )
+                else:
+                    score = fuzz.ratio(stub_line, line)
+                if score > best_score:
+                    best_score = score
+                    best_line = line
+            if best_score < 100:
+                unmatched.append((best_score, stub_line, best_line))
+        return unmatched
+
+    rng = random.Random(0)
+    tokens = ["x", "y", " = ", "np.", "mean", "(", ")", "[0]", ", ", "...", "1", "  "]
+
+    def random_line():
+        return "".join(rng.choice(tokens) for _ in range(rng.randint(1, 8)))
+
+    for _ in range(200):
+        solu_lines = [random_line() for _ in range(rng.randint(0, 12))]
+        stub_lines = [random_line() for _ in range(rng.randint(1, 6))]
+        stub_lines += rng.sample(solu_lines, min(2, len(solu_lines)))
+        stub_lines = [line for line in stub_lines if line.replace("...", "")]
+        assert unmatched_lines(stub_lines, solu_lines) == reference(stub_lines, solu_lines)
+
+
 def skip_code(line):
     """Return True if a code line should be skipped based on contents."""
-    line = dedent(line)
+    line = line.lstrip(" \t")
     return not line or "NotImplementedError" in line
 
 
 def skip_comment(line):
     """Return True if a comment line should be skipped based on contents."""
-    line = dedent(line)
+    line = line.lstrip(" \t")
     return not line or "to_remove" in line or "uncomment" in line.lower()
 
 
@@ -252,6 +456,27 @@ def parse_args(arglist):
         default="",
         help="Will exit cleanly if message contains 'skip verify'",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of notebooks to verify in parallel (default: all cores)",
+    )
+    parser.add_argument(
+        "--cache",
+        default=os.path.join(CACHE_DIR, "logical_lines.json"),
+        help="Path of the JSON file caching parsed exercise and solution cells",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_false",
+        dest="use_cache",
+        help="Parse every cell again rather than reusing cached results",
+    )
+    parser.add_argument(
+        "--json",
+        help="Also write the results for each exercise to this JSON file",
+    )
     return parser.parse_args(arglist)
 
 
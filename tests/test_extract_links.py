@@ -0,0 +1,99 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from subprocess import run
+from pytest import fixture
+import nbformat
+from nbformat.v4 import new_notebook, new_code_cell
+
+OSF_FILES = {"abcde": "C1U1_Slides.pdf"}
+
+
+class StubOSFHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        link_id = self.path.rstrip("/").split("/")[-1]
+        if link_id in OSF_FILES:
+            status = 200
+            body = {"data": {"attributes": {"name": OSF_FILES[link_id]}}}
+        else:
+            status = 404
+            body = {"errors": [{"detail": "Not found."}]}
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@fixture
+def osf_api():
+    StubOSFHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOSFHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v2"
+    server.shutdown()
+    server.server_close()
+
+
+@fixture
+def notebooks(tmp_path):
+    sources = {
+        "C1U1_MiniUnit1": [
+            'video_ids = [("Youtube", "yt1"), ("Bilibili", "bv1")]',
+            'link_id = "abcde"',
+        ],
+        "C1U1_MiniUnit2": [
+            'video_ids = [("Youtube", "yt2"), ("Bilibili", "bv2")]\n'
+            'video_ids = [("Youtube", "yt2"), ("Bilibili", "bv2")]',
+            'link_id = "abcde"\nlink_id = "zzzzz"',
+        ],
+    }
+    nb_paths = []
+    for nb_name, cells in sources.items():
+        nb_path = str(tmp_path / f"{nb_name}.ipynb")
+        nbformat.write(new_notebook(cells=[new_code_cell(s) for s in cells]), nb_path)
+        nb_paths.append(nb_path)
+    return nb_paths
+
+
+def test_extract_links(osf_api, notebooks, tmp_path):
+
+    cache = str(tmp_path / "osf_cache.json")
+    cmdline = ["python", "scripts/extract_links.py", "--osf-api", osf_api, "--cache", cache]
+    res = run(cmdline + notebooks, capture_output=True)
+    assert not res.returncode
+
+    links = json.loads(res.stdout.decode("utf-8"))
+    assert links["videos"] == {
+        "C1U1_MiniUnit1": ["https://youtube.com/watch?v=yt1"],
+        "C1U1_MiniUnit2": ["https://youtube.com/watch?v=yt2"],
+    }
+    assert links["slides"] == {"https://osf.io/download/abcde": "C1U1_Slides.pdf"}
+
+    stderr = res.stderr.decode("utf-8")
+    assert "HTTP Error 404" in stderr
+    assert "Skipping slide https://osf.io/download/zzzzz" in stderr
+
+    # Each slide is only looked up once
+    assert sorted(StubOSFHandler.requests) == ["/v2/files/abcde/", "/v2/files/zzzzz/"]
+
+    # Warm runs are answered from the cache, including the missing file
+    res = run(cmdline + notebooks, capture_output=True)
+    assert not res.returncode
+    assert json.loads(res.stdout.decode("utf-8")) == links
+    assert "HTTP Error 404" in res.stderr.decode("utf-8")
+    assert len(StubOSFHandler.requests) == 2
+
+    res = run(cmdline + ["--refresh"] + notebooks, capture_output=True)
+    assert not res.returncode
+    assert len(StubOSFHandler.requests) == 4
@@ -1,5 +1,17 @@
+import os
+import json
+import shutil
+from importlib.util import find_spec
 from subprocess import run
 from pytest import fixture
+import nbformat
+from nbformat.v4 import new_notebook, new_code_cell
+
+
+@fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep each test's execution cache out of the user's home directory
+    monkeypatch.setenv("C4R_CACHE_DIR", str(tmp_path / "c4r_cache"))
 
 
 @fixture
@@ -13,7 +25,7 @@ def test_raises_not_implemented_error(cmd):
     cmdline = cmd + ["--check-only", "--execute", nb]
     res = run(cmdline, capture_output=True)
     assert not res.returncode
-    assert nb in res.stdout.decode("utf-8")
+    assert f"Executing {nb}" in res.stdout.decode("utf-8")
 
 
 def test_raises_name_error(cmd):
@@ -64,3 +76,216 @@ def test_executed_successfully(cmd):
     res = run(cmdline, capture_output=True)
     assert not res.returncode
     assert nb in res.stdout.decode("utf-8")
+
+
+def test_parallel_execution(cmd):
+
+    nbs = [
+        "units/raises_notimplemented_error.ipynb",
+        "units/raises_name_error.ipynb",
+    ]
+    cmdline = cmd + ["--check-only", "--execute", "--jobs", "2"] + nbs
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    stderr = res.stderr.decode("utf-8")
+    assert nbs[0] not in stderr
+    assert nbs[1] in stderr
+    assert "NameError" in stderr
+
+    # Errors from worker processes are reported as in a serial run (kernel
+    # startup warnings logged before the report may differ)
+    serial = run(cmd + ["--check-only", "--execute", "--jobs", "1"] + nbs, capture_output=True)
+    serial_stderr = serial.stderr.decode("utf-8")
+    report = f"{nbs[1]} failed quality control."
+    assert serial_stderr[serial_stderr.index(report):] == stderr[stderr.index(report):]
+
+
+def test_execution_cache(cmd, tmp_path):
+
+    nb = "units/raises_notimplemented_error.ipynb"
+    cmdline = cmd + ["--check-only", "--execute", "--cache-dir", str(tmp_path), nb]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert f"Executing {nb}" in res.stdout.decode("utf-8")
+
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert f"Using cached execution of {nb}" in res.stdout.decode("utf-8")
+
+    res = run(cmdline + ["--no-cache"], capture_output=True)
+    assert not res.returncode
+    assert f"Executing {nb}" in res.stdout.decode("utf-8")
+
+
+def test_skips_unchanged_derived_notebooks(tmp_path):
+
+    script = os.path.abspath("scripts/process_notebooks.py")
+    os.mkdir(tmp_path / "units")
+    shutil.copy("units/executed_successfully.ipynb", tmp_path / "units")
+    cmdline = ["python", script, "units/executed_successfully.ipynb"]
+
+    # The first pass rewrites the source notebook without outputs
+    for _ in range(2):
+        res = run(cmdline, capture_output=True, cwd=tmp_path)
+        assert not res.returncode
+        assert "Skipping" not in res.stdout.decode("utf-8")
+
+    student_nb = tmp_path / "units" / "student" / "executed_successfully.ipynb"
+    mtime = os.stat(student_nb).st_mtime_ns
+
+    res = run(cmdline, capture_output=True, cwd=tmp_path)
+    assert not res.returncode
+    assert "Skipping unchanged derived notebooks" in res.stdout.decode("utf-8")
+    assert os.stat(student_nb).st_mtime_ns == mtime
+
+    # Changes to the script itself invalidate the manifest
+    os.mkdir(tmp_path / "scripts")
+    shutil.copy("scripts/result_cache.py", tmp_path / "scripts")
+    modified_script = str(tmp_path / "scripts" / "process_notebooks.py")
+    with open(script) as src, open(modified_script, "w") as dst:
+        dst.write(src.read() + "\n# modified\n")
+    res = run(["python", modified_script] + cmdline[2:], capture_output=True, cwd=tmp_path)
+    assert not res.returncode
+    assert "Skipping" not in res.stdout.decode("utf-8")
+
+
+def test_streaming_writes_nothing_on_failure(tmp_path):
+
+    script = os.path.abspath("scripts/process_notebooks.py")
+    os.mkdir(tmp_path / "units")
+    nbs = ["units/executed_successfully.ipynb", "units/executed_out_of_order.ipynb"]
+    for nb in nbs:
+        shutil.copy(nb, tmp_path / "units")
+
+    cmdline = ["python", script, "--memory-budget", "1", "--jobs", "2"] + nbs
+    res = run(cmdline, capture_output=True, cwd=tmp_path)
+    assert res.returncode
+    assert "not sequentially executed" in res.stderr.decode("utf-8")
+    assert sorted(os.listdir(tmp_path)) == ["units"]
+    assert sorted(os.listdir(tmp_path / "units")) == sorted(os.path.basename(nb) for nb in nbs)
+    with open(nbs[0]) as f, open(tmp_path / nbs[0]) as g:
+        assert f.read() == g.read()
+
+    res = run(cmdline[:-1], capture_output=True, cwd=tmp_path)
+    assert not res.returncode
+    assert os.path.exists(tmp_path / "units" / "student" / "executed_successfully.ipynb")
+
+
+def test_execution_profile(cmd, tmp_path):
+
+    nb = "units/raises_notimplemented_error.ipynb"
+    report = tmp_path / "profile.json"
+    cmdline = cmd + [
+        "--check-only", "--execute", "--no-cache", "--profile", str(report), nb
+    ]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Slowest 1 cells" in res.stdout.decode("utf-8")
+
+    with open(report) as f:
+        cells = json.load(f)["notebooks"][nb]["cells"]
+    assert [cell["cell"] for cell in cells] == [0]
+    assert cells[0]["wall_time"] > 0
+
+
+def test_warm_kernels_reset_namespace(cmd, tmp_path):
+
+    nbs = []
+    for name, source in [("first", "leak = 1"), ("second", "print(leak)")]:
+        nb_path = str(tmp_path / f"{name}.ipynb")
+        nbformat.write(new_notebook(cells=[new_code_cell(source)]), nb_path)
+        nbs.append(nb_path)
+
+    cmdline = cmd + ["--check-only", "--execute", "--no-cache", "--warm-kernels"]
+    res = run(cmdline + nbs, capture_output=True)
+    assert res.returncode
+    stderr = res.stderr.decode("utf-8")
+    assert nbs[0] not in stderr
+    assert nbs[1] in stderr
+    assert "NameError" in stderr
+
+    nbs = ["units/raises_notimplemented_error.ipynb", "units/executed_successfully.ipynb"]
+    res = run(cmdline + nbs, capture_output=True)
+    assert not res.returncode
+
+
+def test_warm_kernels_reset_state(cmd, tmp_path):
+
+    mutate = [
+        "import os, sys, random",
+        "os.chdir('/')",
+        "sys.path.append('/c4r_leak')",
+        "os.environ['C4R_LEAK'] = '1'",
+        "random.seed(0)",
+    ]
+    check = [
+        "import os, sys, random",
+        "assert os.getcwd() != '/'",
+        "assert '/c4r_leak' not in sys.path",
+        "assert 'C4R_LEAK' not in os.environ",
+        "assert random.random() != 0.8444218515250481",
+    ]
+    if find_spec("numpy") is not None:
+        mutate += ["import numpy as np", "np.random.seed(0)"]
+        check += ["import numpy as np", "assert np.random.rand() != 0.5488135039273248"]
+    if find_spec("matplotlib") is not None:
+        mutate += ["import matplotlib", "matplotlib.rcParams['lines.linewidth'] = 7"]
+        check += ["import matplotlib", "assert matplotlib.rcParams['lines.linewidth'] != 7"]
+
+    nbs = []
+    for name, source in [("mutate", mutate), ("check", check)]:
+        nb_path = str(tmp_path / f"{name}.ipynb")
+        nbformat.write(new_notebook(cells=[new_code_cell("\n".join(source))]), nb_path)
+        nbs.append(nb_path)
+
+    cmdline = cmd + ["--check-only", "--execute", "--no-cache", "--warm-kernels"]
+    res = run(cmdline + nbs, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+    # Without a snapshot of the matplotlib settings, the kernel is discarded
+    res = run(cmdline + ["--warm-imports", "os"] + nbs, capture_output=True)
+    assert not res.returncode, res.stderr.decode("utf-8")
+
+
+def test_incremental_execution(cmd, tmp_path):
+
+    nb_path = str(tmp_path / "incremental.ipynb")
+    sources = ["a = 1", "b = 2", "print(b)"]
+    nbformat.write(new_notebook(cells=[new_code_cell(s) for s in sources]), nb_path)
+
+    cmdline = cmd + [
+        "--check-only", "--execute", "--incremental",
+        "--cache-dir", str(tmp_path / "cache"), nb_path,
+    ]
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+
+    sources[2] = "print(b + 1)"
+    nbformat.write(new_notebook(cells=[new_code_cell(s) for s in sources]), nb_path)
+    res = run(cmdline, capture_output=True)
+    assert not res.returncode
+    assert "Re-executing 2 of 3 code cells" in res.stdout.decode("utf-8")
+
+    sources[2] = "print(c)"
+    nbformat.write(new_notebook(cells=[new_code_cell(s) for s in sources]), nb_path)
+    res = run(cmdline, capture_output=True)
+    assert res.returncode
+    assert "NameError" in res.stderr.decode("utf-8")
+
+
+def test_fast_check(cmd):
+
+    expected_errors = {
+        "units/executed_out_of_order.ipynb": "not sequentially executed",
+        "units/executed_partially.ipynb": "has unexecuted code cell(s)",
+        "units/executed_with_error.ipynb": "NameError",
+    }
+    for nb, message in expected_errors.items():
+        res = run(cmd + ["--fast-check", nb], capture_output=True)
+        assert res.returncode
+        assert message in res.stderr.decode("utf-8")
+
+    nb = "units/executed_successfully.ipynb"
+    res = run(cmd + ["--fast-check", nb], capture_output=True)
+    assert not res.returncode
+    assert nb in res.stdout.decode("utf-8")
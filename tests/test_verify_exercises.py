@@ -0,0 +1,71 @@
+import json
+from subprocess import run
+import nbformat
+from nbformat.v4 import new_notebook, new_code_cell, new_markdown_cell
+
+SOLUTION = """# to_remove solution
+def double_mean(x):
+    # Average the values
+    y = np.mean(x)
+    return y * 2
+"""
+
+EXERCISE = """def double_mean(x):
+    # Average the values
+    y = ...
+    return y * 3
+    raise NotImplementedError("Student exercise")
+"""
+
+
+def test_verify_exercises(tmp_path):
+
+    cells = {
+        "passes": [
+            new_markdown_cell("# Title"),
+            new_code_cell(EXERCISE.replace("* 3", "* 2")),
+            new_markdown_cell("Solution"),
+            new_code_cell(SOLUTION),
+        ],
+        "fails": [
+            new_markdown_cell("# Title"),
+            new_code_cell(EXERCISE),
+            new_code_cell(SOLUTION),
+        ],
+    }
+    nb_paths = []
+    for nb_name, nb_cells in cells.items():
+        nb_path = str(tmp_path / f"{nb_name}.ipynb")
+        nbformat.write(new_notebook(cells=nb_cells), nb_path)
+        nb_paths.append(nb_path)
+
+    report = str(tmp_path / "report.json")
+    cache = str(tmp_path / "logical_lines.json")
+    cmdline = [
+        "python", "scripts/verify_exercises.py",
+        "--jobs", "2", "--json", report, "--cache", cache,
+    ]
+    res = run(cmdline + nb_paths, capture_output=True)
+    assert res.returncode == 1
+    assert "Failure" in res.stdout.decode("utf-8")
+
+    # Parsed cells are reused on the next run, with the same results
+    res_cached = run(cmdline + nb_paths, capture_output=True)
+    assert res_cached.stdout == res.stdout
+
+    with open(report) as f:
+        results = json.load(f)
+    assert not results["success"]
+    assert results["notebooks"]["passes.ipynb"] == [
+        {"exercise": 1, "passed": True, "code": [], "comments": []}
+    ]
+    assert results["notebooks"]["fails.ipynb"] == [
+        {
+            "exercise": 1,
+            "passed": False,
+            "code": [
+                {"score": 94, "stub": "    return y * 3", "solution": "    return y * 2"}
+            ],
+            "comments": [],
+        }
+    ]